@@ -6,6 +6,8 @@ __version__ = '0.7.1'
 def setup(app):
     """Initialize Sphinx extension."""
     import sphinx
+    from . import (dependencies, headings, highlighting, images, linkcheck,
+                   preparse, references, reporting, scheduling, warmup)
     from .parser import CommonMarkParser
 
     if sphinx.version_info >= (1, 8):
@@ -14,4 +16,19 @@ def setup(app):
     elif sphinx.version_info >= (1, 4):
         app.add_source_parser('.md', CommonMarkParser)
 
-    return {'version': __version__, 'parallel_read_safe': True}
+    dependencies.setup(app)
+    headings.setup(app)
+    highlighting.setup(app)
+    images.setup(app)
+    linkcheck.setup(app)
+    preparse.setup(app)
+    references.setup(app)
+    reporting.setup(app)
+    scheduling.setup(app)
+    warmup.setup(app)
+
+    return {
+        'version': __version__,
+        'parallel_read_safe': True,
+        'parallel_write_safe': True,
+    }
@@ -0,0 +1,145 @@
+"""Render batches of markdown documents from asyncio applications.
+
+Rendering runs the blocking docutils publisher on an executor, so the event
+loop keeps serving other tasks. Usage::
+
+    async for result in render_many(jobs, max_workers=4, timeout=10):
+        if result.error is None:
+            handle(result.index, result.output)
+
+Each job is a ``(source, writer_name, settings_overrides)`` tuple. This
+module uses async generators and needs Python 3.6 or later; it is left out
+of installations on older Pythons.
+"""
+
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from docutils.core import publish_string
+from docutils.writers import get_writer_class
+
+from .parser import CommonMarkParser
+
+__all__ = ['RenderJob', 'RenderResult', 'render', 'render_many']
+
+
+RenderJob = namedtuple('RenderJob',
+                       ['source', 'writer_name', 'settings_overrides'])
+RenderJob.__new__.__defaults__ = ('html', None)
+
+RenderResult = namedtuple('RenderResult', ['index', 'job', 'output', 'error'])
+
+# The parser is safe to share between threads, writers are kept per thread.
+# Both are created lazily, so process pool workers build their own.
+_parser = None
+_local = threading.local()
+
+
+def render(source, writer_name='html', settings_overrides=None):
+    """Render markdown ``source`` with the docutils writer ``writer_name``.
+
+    This is the blocking function run by `render_many`. The parser and the
+    writers are reused across calls made from the same thread or process.
+    """
+    global _parser
+    if _parser is None:
+        _parser = CommonMarkParser()
+    writers = getattr(_local, 'writers', None)
+    if writers is None:
+        writers = _local.writers = {}
+    writer = writers.get(writer_name)
+    if writer is None:
+        writer = writers[writer_name] = get_writer_class(writer_name)()
+    return publish_string(source, parser=_parser, writer=writer,
+                          settings_overrides=settings_overrides)
+
+
+# asyncio.get_running_loop is new in Python 3.7
+_get_running_loop = getattr(asyncio, 'get_running_loop',
+                            asyncio.get_event_loop)
+
+
+async def _render_job(executor, index, job, timeout):
+    loop = _get_running_loop()
+    future = loop.run_in_executor(executor, render, *job)
+    try:
+        output = await asyncio.wait_for(future, timeout)
+    except asyncio.CancelledError:
+        raise
+    except Exception as error:  # pylint: disable=broad-except
+        return RenderResult(index, job, None, error)
+    return RenderResult(index, job, output, None)
+
+
+async def render_many(jobs, max_workers=4, max_pending=None, timeout=None,
+                      executor=None):
+    """Render ``jobs`` concurrently and yield results as they complete.
+
+    Parameters
+    ----------
+    jobs : iterable or async iterable
+        `RenderJob` or ``(source, writer_name, settings_overrides)`` tuples.
+        Jobs are only pulled from ``jobs`` when there is room for them.
+    max_workers : int
+        Size of the thread pool used when no ``executor`` is given.
+    max_pending : int
+        Maximum number of submitted but unfinished jobs, defaults to twice
+        ``max_workers``.
+    timeout : float
+        Time in seconds after which a job is reported as failed with
+        `asyncio.TimeoutError`. A job which already started keeps its
+        worker busy until it finishes.
+    executor : concurrent.futures.Executor
+        Executor to run the jobs on, for instance a ``ProcessPoolExecutor``.
+        It is not shut down by this function.
+
+    Yields
+    ------
+    result : RenderResult
+        ``index`` is the position of the job in ``jobs``, ``error`` is the
+        exception raised by the job, or None on success.
+
+    Closing the generator or cancelling the task consuming it cancels the
+    jobs which have not started yet.
+    """
+    if max_pending is None:
+        max_pending = 2 * max_workers
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers)
+    if hasattr(jobs, '__aiter__'):
+        job_iter = jobs.__aiter__()
+    else:
+        job_iter = iter(jobs)
+    index = 0
+    exhausted = False
+    pending = set()
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    if hasattr(job_iter, '__anext__'):
+                        job = await job_iter.__anext__()
+                    else:
+                        job = next(job_iter)
+                except (StopIteration, StopAsyncIteration):
+                    exhausted = True
+                    break
+                pending.add(asyncio.ensure_future(
+                    _render_job(executor, index, RenderJob(*job), timeout)))
+                index += 1
+            if not pending:
+                break
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+        # Let the cancelled jobs finish, so none is left behind on the loop
+        await asyncio.gather(*pending, return_exceptions=True)
+        if own_executor:
+            executor.shutdown(wait=False)
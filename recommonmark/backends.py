@@ -0,0 +1,209 @@
+"""Markdown backends used by the CommonMark parser.
+
+A backend turns markdown source into a tree of :class:`commonmark.node.Node`
+objects. `CommonMarkParser` only relies on the walker events and the node
+attributes of that tree, so any CommonMark compliant tokenizer can be used
+as long as its output is adapted to these nodes.
+"""
+
+import re
+import time
+
+from commonmark import Parser
+from commonmark.node import Node
+
+__all__ = ['CommonMarkBackend', 'MarkdownItBackend', 'ResourceLimitExceeded',
+           'get_backend']
+
+
+class ResourceLimitExceeded(Exception):
+
+    """Raised when a markdown input exceeds one of the configured limits"""
+
+
+class DeadlineParser(Parser):
+
+    """commonmark parser giving up once the time given to it is over
+
+    The time is checked before each line is added to the block structure,
+    and before the inline content of each paragraph and heading is parsed.
+    """
+
+    def __init__(self, deadline):
+        Parser.__init__(self)
+        self.deadline = deadline
+
+    def check_deadline(self):
+        if time.time() > self.deadline:
+            raise ResourceLimitExceeded(
+                'max_parse_time exceeded while tokenizing')
+
+    def incorporate_line(self, ln):
+        self.check_deadline()
+        Parser.incorporate_line(self, ln)
+
+    def process_inlines(self, block):
+        walker = block.walker()
+        self.inline_parser.refmap = self.refmap
+        self.inline_parser.options = self.options
+        event = walker.nxt()
+        while event is not None:
+            node = event['node']
+            if not event['entering'] and node.t in ('paragraph', 'heading'):
+                self.check_deadline()
+                self.inline_parser.parse(node)
+            event = walker.nxt()
+
+
+class CommonMarkBackend(object):
+
+    """Backend using the pure Python ``commonmark`` package
+
+    Backends whose `parse` accepts a ``deadline`` timestamp, after which it
+    raises `ResourceLimitExceeded`, set ``supports_deadline``.
+    """
+
+    name = 'commonmark'
+    supports_deadline = True
+
+    def parse(self, text, deadline=None):
+        if deadline is not None:
+            return DeadlineParser(deadline).parse(text)
+        return Parser().parse(text)
+
+
+class MarkdownItBackend(object):
+
+    """Backend using the ``markdown-it-py`` tokenizer in CommonMark mode
+
+    The flat token stream of markdown-it is rebuilt into commonmark nodes.
+    Tokens without a commonmark counterpart, for instance those of enabled
+    markdown-it extensions, become ``custom_block`` or ``custom_inline``
+    nodes holding the token type, without its ``_open`` suffix, in ``info``
+    and its content in ``literal``.
+    """
+
+    name = 'markdown-it'
+
+    # Maps the opening token types of markdown-it to commonmark node types
+    container_types = {
+        'heading_open': 'heading',
+        'paragraph_open': 'paragraph',
+        'bullet_list_open': 'list',
+        'ordered_list_open': 'list',
+        'list_item_open': 'item',
+        'blockquote_open': 'block_quote',
+        'em_open': 'emph',
+        'strong_open': 'strong',
+        'link_open': 'link',
+    }
+
+    leaf_types = {
+        'text': 'text',
+        'softbreak': 'softbreak',
+        'hardbreak': 'linebreak',
+        'code_inline': 'code',
+        'html_inline': 'html_inline',
+        'html_block': 'html_block',
+        'code_block': 'code_block',
+        'fence': 'code_block',
+        'hr': 'thematic_break',
+    }
+
+    def __init__(self):
+        from markdown_it import MarkdownIt
+        from markdown_it.common.utils import unescapeAll
+        self._md = MarkdownIt('commonmark')
+        self._unescape = unescapeAll
+
+    def parse(self, text):
+        root = Node('document', [[1, 1], [0, 0]])
+        self._convert_tokens(self._md.parse(text), root)
+        return root
+
+    def _convert_tokens(self, tokens, parent):
+        for token in tokens:
+            if token.nesting == -1:
+                parent = parent.parent
+            elif token.type == 'inline':
+                self._convert_tokens(token.children, parent)
+            elif token.nesting == 1:
+                node = self._make_node(
+                    self.container_types.get(token.type) or
+                    self._custom_type(token), token)
+                parent.append_child(node)
+                parent = node
+            elif token.type == 'text' and not token.content:
+                # Leftovers of emphasis delimiters, commonmark drops them
+                continue
+            elif token.type == 'image':
+                node = self._make_node('image', token)
+                parent.append_child(node)
+                self._convert_tokens(token.children, node)
+            else:
+                parent.append_child(self._make_node(
+                    self.leaf_types.get(token.type) or
+                    self._custom_type(token), token))
+
+    @staticmethod
+    def _custom_type(token):
+        return 'custom_block' if token.block else 'custom_inline'
+
+    def _make_node(self, node_type, token):
+        sourcepos = None
+        if token.map:
+            sourcepos = [[token.map[0] + 1, 1], [token.map[1], 0]]
+        node = Node(node_type, sourcepos)
+        if node_type == 'heading':
+            node.level = int(token.tag[1:])
+        elif node_type == 'list':
+            node.list_data = {
+                'type': 'bullet' if token.type == 'bullet_list_open'
+                else 'ordered',
+                'start': int(token.attrGet('start') or 1),
+            }
+        elif node_type in ('link', 'image'):
+            node.destination = token.attrGet('href' if node_type == 'link'
+                                             else 'src')
+            node.title = token.attrGet('title') or ''
+        elif node_type == 'code_block':
+            node.literal = token.content
+            node.is_fenced = token.type == 'fence'
+            if node.is_fenced:
+                node.info = self._unescape(token.info).strip()
+        elif node_type in ('custom_block', 'custom_inline'):
+            node.info = re.sub(r'_open$', '', token.type)
+            node.literal = token.content
+        elif node_type == 'html_block':
+            # commonmark strips the trailing blank lines of html blocks
+            node.literal = re.sub(r'(\n *)+$', '', token.content)
+        else:
+            node.literal = token.content
+        return node
+
+
+_backends = {
+    CommonMarkBackend.name: CommonMarkBackend,
+    MarkdownItBackend.name: MarkdownItBackend,
+}
+
+_instances = {}
+
+
+def get_backend(name):
+    """Return the backend registered under ``name``.
+
+    ``name`` may also be a backend instance, which is returned as is.
+    """
+    if hasattr(name, 'parse'):
+        return name
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+    try:
+        backend_class = _backends[name]
+    except KeyError:
+        raise ValueError('Unknown markdown backend: {0}'.format(name))
+    backend = _instances[name] = backend_class()
+    return backend
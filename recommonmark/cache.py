@@ -0,0 +1,191 @@
+"""Size bounded on-disk cache for serialized build artifacts.
+
+Entries are authenticated with an HMAC keyed on a secret of the current
+user, so a cache directory which other users can write to cannot be used to
+feed forged entries (and with them pickled objects) to the build.
+"""
+
+import errno
+import hashlib
+import hmac
+import os
+import tempfile
+import zlib
+
+__all__ = ['DiskCache', 'make_key', 'user_key']
+
+MAGIC = b'RCMC2'
+
+# File holding the secret of the current user, created on first use
+KEY_FILE = os.path.join(os.path.expanduser('~'), '.recommonmark', 'cache.key')
+
+_user_keys = {}
+
+
+def user_key(path=None):
+    """Return the cache secret stored in ``path``, creating it if needed.
+
+    The file and its directory are only accessible to the current user.
+    Raises OSError or IOError if the secret cannot be read or created.
+    """
+    path = path or KEY_FILE
+    if path in _user_keys:
+        return _user_keys[path]
+    try:
+        with open(path, 'rb') as fin:
+            key = fin.read()
+    except (IOError, OSError):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except OSError as error:
+            # Another process created the secret first
+            if error.errno != errno.EEXIST:
+                raise
+            with open(path, 'rb') as fin:
+                key = fin.read()
+        else:
+            key = os.urandom(32)
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(key)
+    if not key:
+        raise IOError('empty cache key file: {0}'.format(path))
+    _user_keys[path] = key
+    return key
+
+
+def make_key(*parts):
+    """Hash ``parts`` into a cache key.
+
+    Text parts are encoded as UTF-8, other parts are hashed by their repr.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            if not isinstance(part, type(u'')):
+                part = repr(part)
+            part = part.encode('utf-8')
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+
+    """Store compressed blobs in a directory, one file per key.
+
+    Each entry holds an HMAC of its content keyed on ``key``, the secret of
+    the current user by default, and corrupt or forged entries are dropped
+    when read. If the secret is not available, nothing is cached. Entries are written atomically, so several processes
+    can share a cache directory. Once the directory grows over ``max_size``
+    bytes, the least recently used entries are evicted. The size of the
+    directory is listed again when the entries written since the last
+    listing may have made it too large, and after every eighth of
+    ``max_size`` written, since other processes sharing the directory add
+    entries as well.
+    """
+
+    suffix = '.cache'
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024, key=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._key = key
+        # Size of the directory at the last listing, and bytes written since
+        self._size = None
+        self._written = 0
+
+    def _sign(self, payload):
+        if self._key is None:
+            try:
+                self._key = user_key()
+            except (IOError, OSError):
+                return None
+        return hmac.new(self._key, payload, hashlib.sha256).digest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Return the data stored for ``key``, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fin:
+                blob = fin.read()
+        except (IOError, OSError):
+            return None
+        header = len(MAGIC) + hashlib.sha256().digest_size
+        signature, payload = blob[len(MAGIC):header], blob[header:]
+        expected = self._sign(payload)
+        if expected is None:
+            return None
+        if blob[:len(MAGIC)] != MAGIC or not hmac.compare_digest(
+                expected, signature):
+            self._remove(path)
+            return None
+        try:
+            data = zlib.decompress(payload)
+        except zlib.error:
+            self._remove(path)
+            return None
+        # Record the access for the least recently used eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def set(self, key, data):
+        """Store ``data`` for ``key`` and evict old entries if needed."""
+        payload = zlib.compress(data)
+        signature = self._sign(payload)
+        if signature is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0o700)
+        blob = MAGIC + signature + payload
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                fout.write(blob)
+            replace = getattr(os, 'replace', os.rename)
+            replace(tmp_path, self._path(key))
+        except (IOError, OSError):
+            self._remove(tmp_path)
+            return
+        self._written += len(blob)
+        if (self._size is None or
+                self._size + self._written > self.max_size or
+                self._written > self.max_size // 8):
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under ``max_size``."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+        self._size = total
+        self._written = 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
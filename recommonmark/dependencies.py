@@ -0,0 +1,47 @@
+"""Track the documents referenced by toctrees generated from markdown.
+
+`AutoStructify.auto_toc_tree` records, for every markdown document, which
+docnames its generated toctrees refer to and whether each of them existed
+when the document was read. When one of those documents appears or
+disappears, for instance because it was added, renamed or deleted, the
+referring document is read again on the next incremental build.
+"""
+
+__all__ = ['get_toc_dependencies', 'setup']
+
+
+def get_toc_dependencies(env):
+    """Return the ``{docname: {referenced docname: existed}}`` mapping."""
+    if not hasattr(env, 'recommonmark_toc_dependencies'):
+        env.recommonmark_toc_dependencies = {}
+    return env.recommonmark_toc_dependencies
+
+
+def get_outdated(app, env, added, changed, removed):
+    # Sphinx < 2.0 passes the builder instead of the environment
+    env = getattr(env, 'env', env)
+    outdated = []
+    for docname, targets in get_toc_dependencies(env).items():
+        for target, existed in targets.items():
+            if (target in env.found_docs) != existed:
+                outdated.append(docname)
+                break
+    return outdated
+
+
+def purge_doc(app, env, docname):
+    get_toc_dependencies(env).pop(docname, None)
+
+
+def merge_info(app, env, docnames, other):
+    dependencies = get_toc_dependencies(env)
+    other_dependencies = get_toc_dependencies(other)
+    for docname in docnames:
+        if docname in other_dependencies:
+            dependencies[docname] = other_dependencies[docname]
+
+
+def setup(app):
+    app.connect('env-get-outdated', get_outdated)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
@@ -0,0 +1,68 @@
+"""Index of the headings of markdown documents in a Sphinx build.
+
+`CommonMarkParser` records the level, title, anchor id and source line of
+every heading while parsing. This module moves those records from the
+doctree to the Sphinx environment once the document has been read, so they
+are not stored with the doctree, keeps them merged across parallel readers,
+and can write them all to
+``recommonmark_headings.json`` in the output directory at the end of the
+build, for navigation or search tools to consume.
+
+The JSON file is written when ``heading_index`` is enabled in
+``recommonmark_config``.
+"""
+
+import io
+import json
+import os
+
+__all__ = ['get_heading_index', 'setup']
+
+INDEX_FILE = 'recommonmark_headings.json'
+
+
+def get_heading_index(env):
+    """Return the ``{docname: [(level, title, anchor, line)]}`` index."""
+    if not hasattr(env, 'recommonmark_headings'):
+        env.recommonmark_headings = {}
+    return env.recommonmark_headings
+
+
+def doctree_read(app, doctree):
+    headings = getattr(doctree, 'commonmark_headings', None)
+    if headings is not None:
+        get_heading_index(app.env)[app.env.docname] = list(headings)
+        del doctree.commonmark_headings
+
+
+def purge_doc(app, env, docname):
+    get_heading_index(env).pop(docname, None)
+
+
+def merge_info(app, env, docnames, other):
+    index = get_heading_index(env)
+    other_index = get_heading_index(other)
+    for docname in docnames:
+        if docname in other_index:
+            index[docname] = other_index[docname]
+
+
+def build_finished(app, exception):
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    if exception is not None or not config.get('heading_index'):
+        return
+    index = get_heading_index(app.env)
+    data = dict(
+        (docname, [dict(level=level, title=title, anchor=anchor, line=line)
+                   for level, title, anchor, line in headings])
+        for docname, headings in index.items())
+    path = os.path.join(app.outdir, INDEX_FILE)
+    with io.open(path, 'w', encoding='utf-8') as fout:
+        fout.write(json.dumps(data, sort_keys=True, ensure_ascii=False))
+
+
+def setup(app):
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
+    app.connect('build-finished', build_finished)
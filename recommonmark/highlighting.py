@@ -0,0 +1,146 @@
+"""Persistent cache of the highlighted code blocks of markdown documents.
+
+Highlighting code blocks with Pygments is a large part of the time spent
+writing code heavy documents, and most blocks do not change between builds.
+When ``highlight_cache`` is enabled in ``recommonmark_config``, the markup
+produced for the code blocks of markdown documents by the HTML and LaTeX
+writers is stored in a `DiskCache` in the doctree directory, keyed on
+everything the highlighting depends on: language, code, options, Pygments
+version, style and output format.
+
+The cache is used by a subclass of the translator class of the builder,
+registered with `Sphinx.set_translator`. Entries are written atomically, so
+parallel writers (``-j``) can share the cache. Blocks whose highlighting
+logs a warning, for instance because the code cannot be lexed, are never
+cached so the warning is given on every build.
+"""
+
+import logging
+import os
+from os.path import splitext
+
+import pygments
+
+from .cache import DiskCache, make_key
+
+__all__ = ['CachingHighlighter', 'caching_translator', 'setup']
+
+CACHE_DIR = 'recommonmark_highlight'
+
+# Logger of sphinx.highlighting, as named by sphinx.util.logging
+HIGHLIGHT_LOGGER = 'sphinx.sphinx.highlighting'
+
+
+class _WarningDetector(logging.Filter):
+
+    """Record whether the highlighting logger issued a warning."""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.warned = False
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            self.warned = True
+        return True
+
+
+class CachingHighlighter(object):
+
+    """Wrap a Sphinx ``PygmentsBridge`` to cache its results.
+
+    Only the blocks of documents for which ``is_cached(docname)`` is true
+    are cached, other calls go straight to ``highlighter``. Cache hits and
+    misses are counted in the ``stats`` dict.
+    """
+
+    def __init__(self, highlighter, cache, is_cached, stats=None):
+        self.highlighter = highlighter
+        self.cache = cache
+        self.is_cached = is_cached
+        self.stats = {'hits': 0, 'misses': 0} if stats is None else stats
+        bridge = type(highlighter)
+        self._key_prefix = (
+            pygments.__version__, bridge.__module__, bridge.__name__,
+            highlighter.dest, highlighter.formatter.__name__,
+            sorted((name, repr(value)) for name, value in
+                   highlighter.formatter_args.items()),
+            getattr(highlighter, 'trim_doctest_flags', None))
+
+    def __getattr__(self, name):
+        return getattr(self.highlighter, name)
+
+    def highlight_block(self, source, lang, opts=None, location=None,
+                        force=False, **kwargs):
+        docname = location[0] if isinstance(location, tuple) else None
+        if docname is None or not self.is_cached(docname):
+            return self.highlighter.highlight_block(
+                source, lang, opts=opts, location=location, force=force,
+                **kwargs)
+        key = make_key(self._key_prefix, lang, source,
+                       sorted((opts or {}).items()), force,
+                       sorted(kwargs.items()))
+        data = self.cache.get(key)
+        if data is not None:
+            self.stats['hits'] += 1
+            return data.decode('utf-8')
+        self.stats['misses'] += 1
+        # Only listen to the logger while this block is highlighted
+        detector = _WarningDetector()
+        logger = logging.getLogger(HIGHLIGHT_LOGGER)
+        logger.addFilter(detector)
+        try:
+            highlighted = self.highlighter.highlight_block(
+                source, lang, opts=opts, location=location, force=force,
+                **kwargs)
+        finally:
+            logger.removeFilter(detector)
+        if not detector.warned:
+            self.cache.set(key, highlighted.encode('utf-8'))
+        return highlighted
+
+
+def caching_translator(translator_class, cache, is_cached, stats=None):
+    """Return a subclass of ``translator_class`` which highlights code blocks
+    through a `CachingHighlighter`."""
+
+    def __init__(self, *args, **kwargs):
+        translator_class.__init__(self, *args, **kwargs)
+        highlighter = getattr(self, 'highlighter', None)
+        if highlighter is not None and hasattr(highlighter, 'formatter_args'):
+            self.highlighter = CachingHighlighter(
+                highlighter, cache, is_cached, stats)
+
+    return type('Caching' + translator_class.__name__, (translator_class,),
+                {'__init__': __init__})
+
+
+def builder_inited(app):
+    from .parser import CommonMarkParser
+
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    if not config.get('highlight_cache'):
+        return
+    cache = DiskCache(os.path.join(app.doctreedir, CACHE_DIR),
+                      config.get('highlight_cache_size', 100 * 1024 * 1024))
+    stats = app.recommonmark_highlight_stats = {'hits': 0, 'misses': 0}
+    markdown_docs = {}
+
+    def is_markdown(docname):
+        if docname not in markdown_docs:
+            suffix = splitext(app.env.doc2path(docname))[1][1:]
+            markdown_docs[docname] = suffix in CommonMarkParser.supported
+        return markdown_docs[docname]
+
+    get_translator_class = getattr(app.builder, 'get_translator_class', None)
+    translator_class = get_translator_class and get_translator_class()
+    if translator_class is None:
+        return
+    app.set_translator(
+        app.builder.name,
+        caching_translator(translator_class, cache, is_markdown, stats),
+        override=True)
+
+
+def setup(app):
+    app.connect('builder-inited', builder_inited)
@@ -0,0 +1,207 @@
+"""Manifest of the images used by markdown documents in a Sphinx build.
+
+When ``image_manifest`` is enabled in ``recommonmark_config``, this module
+keeps, in the Sphinx environment, the image files each markdown document
+uses once it has been read, and the content hash, file size and dimensions
+of each of them. That metadata is only computed again when the
+modification time or size of a file changes, so an image shared by hundreds
+of pages is hashed and probed once, and not again in later builds until it
+changes.
+
+Builders which copy images to their output then copy each unique image
+once: images with the same content, for instance the same screenshot
+checked in under several names, are all pointed to a single file when the
+doctrees are resolved. When the file an image is pointed to changes between
+builds, the documents using it are written again. The manifest is also
+written to ``recommonmark_images.json`` in the output directory at the end
+of the build.
+"""
+
+import hashlib
+import io
+import json
+import os
+
+from docutils import nodes
+from sphinx.util.images import get_image_size
+
+__all__ = ['get_image_info', 'get_image_manifest', 'get_image_targets',
+           'setup']
+
+MANIFEST_FILE = 'recommonmark_images.json'
+
+
+def get_image_manifest(env):
+    """Return the ``{docname: [image path, ...]}`` manifest."""
+    if not hasattr(env, 'recommonmark_images'):
+        env.recommonmark_images = {}
+    return env.recommonmark_images
+
+
+def get_image_info(env):
+    """Return the ``{image path: (mtime, size, sha1, width, height)}`` cache.
+
+    Paths are relative to the source directory, like the keys of
+    ``env.images``. The dimensions are None when they cannot be probed.
+    """
+    if not hasattr(env, 'recommonmark_image_info'):
+        env.recommonmark_image_info = {}
+    return env.recommonmark_image_info
+
+
+def get_image_targets(env):
+    """Return the ``{image path: image path}`` map of duplicate images.
+
+    All images with the same content are mapped to the one with the
+    smallest path, which keeps the output names stable across builds.
+    """
+    if not hasattr(env, 'recommonmark_image_targets'):
+        env.recommonmark_image_targets = {}
+    return env.recommonmark_image_targets
+
+
+def _enabled(app):
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    return bool(config.get('image_manifest'))
+
+
+def _hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def update_image_info(app, imgpath):
+    """Refresh the metadata of ``imgpath`` if the file changed."""
+    checked = getattr(app, 'recommonmark_images_checked', None)
+    if checked is None:
+        checked = app.recommonmark_images_checked = set()
+    info = get_image_info(app.env)
+    if imgpath in checked:
+        return info.get(imgpath)
+    checked.add(imgpath)
+    filename = os.path.join(app.srcdir, imgpath)
+    try:
+        stat = os.stat(filename)
+        cached = info.get(imgpath)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            size = get_image_size(filename) or (None, None)
+            info[imgpath] = (stat.st_mtime, stat.st_size,
+                             _hash_file(filename), size[0], size[1])
+    except (IOError, OSError):
+        info.pop(imgpath, None)
+    return info.get(imgpath)
+
+
+def doctree_read(app, doctree):
+    if not getattr(doctree, 'commonmark_parsed', False) or not _enabled(app):
+        return
+    paths = []
+    for node in doctree.traverse(nodes.image):
+        # The image collector of Sphinx has resolved the candidate files
+        for key, imgpath in sorted(node.get('candidates', {}).items()):
+            if key == '?' or imgpath in paths:
+                continue
+            if imgpath in app.env.images and update_image_info(app, imgpath):
+                paths.append(imgpath)
+    get_image_manifest(app.env)[app.env.docname] = paths
+
+
+def purge_doc(app, env, docname):
+    get_image_manifest(env).pop(docname, None)
+
+
+def merge_info(app, env, docnames, other):
+    manifest = get_image_manifest(env)
+    other_manifest = get_image_manifest(other)
+    info = get_image_info(env)
+    other_info = get_image_info(other)
+    for docname in docnames:
+        if docname in other_manifest:
+            manifest[docname] = other_manifest[docname]
+            for imgpath in manifest[docname]:
+                if imgpath in other_info:
+                    info[imgpath] = other_info[imgpath]
+
+
+def env_updated(app, env):
+    used = set()
+    for paths in get_image_manifest(env).values():
+        used.update(paths)
+    info = get_image_info(env)
+    for imgpath in list(info):
+        if imgpath not in used:
+            del info[imgpath]
+    if not _enabled(app):
+        app.recommonmark_images_checked = None
+        return None
+    # Images only used by documents which were not read again may have
+    # changed as well
+    for imgpath in sorted(used):
+        if imgpath in env.images:
+            update_image_info(app, imgpath)
+    app.recommonmark_images_checked = None
+
+    by_hash = {}
+    for imgpath, (_, _, sha1, _, _) in info.items():
+        if imgpath in env.images:
+            by_hash.setdefault(sha1, []).append(imgpath)
+    targets = {}
+    for paths in by_hash.values():
+        if len(paths) > 1:
+            for imgpath in paths:
+                targets[imgpath] = min(paths)
+    previous = get_image_targets(env)
+    env.recommonmark_image_targets = targets
+    # Documents written against other targets must be written again
+    docnames = set()
+    for imgpath in set(previous) | set(targets):
+        if previous.get(imgpath) != targets.get(imgpath) and (
+                imgpath in env.images):
+            docnames.update(env.images[imgpath][0])
+    return sorted(docname for docname in docnames
+                  if docname in env.all_docs)
+
+
+def doctree_resolved(app, doctree, docname):
+    targets = get_image_targets(app.env)
+    if not targets or not _enabled(app) or not hasattr(
+            app.builder, 'copy_image_files'):
+        return
+    for node in doctree.traverse(nodes.image):
+        candidates = node.get('candidates', {})
+        for key, imgpath in list(candidates.items()):
+            if imgpath in targets:
+                candidates[key] = targets[imgpath]
+        if node.get('uri') in targets:
+            node['uri'] = targets[node['uri']]
+
+
+def build_finished(app, exception):
+    if exception is not None or not _enabled(app):
+        return
+    info = get_image_info(app.env)
+    targets = get_image_targets(app.env)
+    data = {
+        'documents': get_image_manifest(app.env),
+        'images': dict(
+            (imgpath, dict(sha1=sha1, size=size, width=width, height=height,
+                           output=app.env.images[
+                               targets.get(imgpath, imgpath)][1]))
+            for imgpath, (_, size, sha1, width, height) in info.items()
+            if imgpath in app.env.images),
+    }
+    path = os.path.join(app.outdir, MANIFEST_FILE)
+    with io.open(path, 'w', encoding='utf-8') as fout:
+        fout.write(json.dumps(data, sort_keys=True, ensure_ascii=False))
+
+
+def setup(app):
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
+    app.connect('env-updated', env_updated)
+    app.connect('doctree-resolved', doctree_resolved)
+    app.connect('build-finished', build_finished)
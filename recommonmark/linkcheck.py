@@ -0,0 +1,173 @@
+"""Check the external links of markdown documents from an index.
+
+Once a markdown document has been read and transformed, the destination
+and source line of every link in its doctree which is not a pending
+cross-reference are recorded. Links rewritten or created by `AutoStructify`
+are therefore indexed as they will be written, and toctree entries are not
+indexed. This module keeps those records in the Sphinx environment,
+deduplicated by document and merged across parallel readers, and provides
+the ``mdlinkcheck`` builder.
+
+The builder reports the same results as Sphinx's ``linkcheck`` builder, but
+takes the links of markdown documents from the index instead of loading and
+walking their doctrees, and checks each unique URL of the project once on
+the pool of ``linkcheck_workers`` threads. When ``linkcheck_cache_ttl`` is
+set in ``recommonmark_config``, the URLs found working or redirected are
+remembered in the doctree directory and not checked again for that many
+seconds.
+"""
+
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.builders.linkcheck import CheckExternalLinksBuilder
+
+__all__ = ['MarkdownLinkCheckBuilder', 'get_link_index', 'setup']
+
+CACHE_FILE = 'recommonmark_linkcheck.json'
+
+
+def get_link_index(env):
+    """Return the ``{docname: [(uri, [line, ...])]}`` index."""
+    if not hasattr(env, 'recommonmark_links'):
+        env.recommonmark_links = {}
+    return env.recommonmark_links
+
+
+def _in_pending_xref(node):
+    while node is not None:
+        if isinstance(node, addnodes.pending_xref):
+            return True
+        node = node.parent
+    return False
+
+
+def iter_links(doctree, skip_pending=False):
+    """Yield the ``(uri, line)`` of the references of ``doctree``.
+
+    Lines are found like the linkcheck builder does, from the parents of the
+    reference. With ``skip_pending``, references in unresolved
+    cross-references are skipped.
+    """
+    for node in doctree.traverse(nodes.reference):
+        if 'refuri' not in node:
+            continue
+        if skip_pending and _in_pending_xref(node):
+            continue
+        uri = node['refuri']
+        lineno = None
+        while lineno is None:
+            node = node.parent
+            if node is None:
+                break
+            lineno = node.line
+        yield uri, lineno
+
+
+def doctree_read(app, doctree):
+    if not getattr(doctree, 'commonmark_parsed', False):
+        return
+    lines = OrderedDict()
+    for uri, line in iter_links(doctree, skip_pending=True):
+        lines.setdefault(uri, []).append(line)
+    get_link_index(app.env)[app.env.docname] = list(lines.items())
+
+
+def purge_doc(app, env, docname):
+    get_link_index(env).pop(docname, None)
+
+
+def merge_info(app, env, docnames, other):
+    index = get_link_index(env)
+    other_index = get_link_index(other)
+    for docname in docnames:
+        if docname in other_index:
+            index[docname] = other_index[docname]
+
+
+class MarkdownLinkCheckBuilder(CheckExternalLinksBuilder):
+
+    """Check external links, each unique URL once, using the link index."""
+
+    name = 'mdlinkcheck'
+
+    def init(self):
+        CheckExternalLinksBuilder.init(self)
+        config = getattr(self.config, 'recommonmark_config', None) or {}
+        self.cache_ttl = config.get('linkcheck_cache_ttl')
+        self.cache_path = os.path.join(self.doctreedir, CACHE_FILE)
+        self.cache = {}
+        if self.cache_ttl and os.path.exists(self.cache_path):
+            try:
+                with io.open(self.cache_path, encoding='utf-8') as fin:
+                    self.cache = json.load(fin)
+            except ValueError:
+                pass
+        self.checked = self.cached = 0
+
+    def write(self, build_docnames, updated_docnames, method='update'):
+        index = get_link_index(self.env)
+        occurrences = []
+        for docname in sorted(build_docnames):
+            if docname in index:
+                for uri, lines in index[docname]:
+                    occurrences.extend((uri, docname, line) for line in lines)
+                continue
+            doctree = self.env.get_doctree(docname)
+            occurrences.extend((uri, docname, line)
+                               for uri, line in iter_links(doctree))
+        results = self.check_uris(
+            OrderedDict.fromkeys(uri for uri, _, _ in occurrences))
+        reported = set()
+        for uri, docname, lineno in occurrences:
+            status, info, code = results[uri]
+            if uri in reported and status == 'working':
+                # Like the linkcheck builder, only report a working URL once
+                info = 'old'
+            reported.add(uri)
+            self.process_result((uri, docname, lineno, status, info, code))
+        if self.broken:
+            self.app.statuscode = 1
+
+    def check_uris(self, uris):
+        """Return the ``(status, info, code)`` of each of ``uris``."""
+        results = {}
+        now = time.time()
+        pending = 0
+        for uri in uris:
+            entry = self.cache.get(uri)
+            if entry is not None and now - entry[3] < self.cache_ttl:
+                results[uri] = tuple(entry[:3])
+                self.cached += 1
+                continue
+            self.wqueue.put((uri, None, None), False)
+            pending += 1
+        self.checked += pending
+        for _ in range(pending):
+            uri, _, _, status, info, code = self.rqueue.get()
+            results[uri] = (status, info, code)
+            if self.cache_ttl and status in ('working', 'redirected'):
+                self.cache[uri] = [status, info, code, now]
+        return results
+
+    def finish(self):
+        CheckExternalLinksBuilder.finish(self)
+        if not self.cache_ttl:
+            return
+        now = time.time()
+        cache = dict((uri, entry) for uri, entry in self.cache.items()
+                     if now - entry[3] < self.cache_ttl)
+        with io.open(self.cache_path, 'w', encoding='utf-8') as fout:
+            fout.write(json.dumps(cache, sort_keys=True, ensure_ascii=False))
+
+
+def setup(app):
+    app.add_builder(MarkdownLinkCheckBuilder)
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
@@ -1,12 +1,19 @@
 """Docutils CommonMark parser"""
 
+import re
 import sys
+import threading
+import time
+import weakref
 from os.path import splitext
 
 from docutils import parsers, nodes
 from sphinx import addnodes
+from sphinx.util import logging
 
-from commonmark import Parser
+from .backends import ResourceLimitExceeded, get_backend
+from .preparse import take_preparsed
+from .reporting import DEFAULT_EXAMPLES, WarningAggregator
 
 from warnings import warn
 
@@ -15,52 +22,371 @@ if sys.version_info < (3, 0):
 else:
     from urllib.parse import urlparse, unquote
 
-__all__ = ['CommonMarkParser']
+__all__ = ['CommonMarkParser', 'ResourceLimitExceeded', 'classify_link']
+
+logger = logging.getLogger(__name__)
+
+
+def classify_link(destination, known_url_schemes=None,
+                  supported=('md', 'markdown')):
+    """Classify a link destination like `CommonMarkParser.visit_link` does.
+
+    Returns a tuple ``(destination, is_xref)``, where ``destination`` has the
+    extension of linked markdown documents removed and ``is_xref`` tells
+    whether the link should be resolved as a cross-reference.
+    """
+    _, ext = splitext(destination)
+
+    # Check if the destination starts with a url scheme, since internal and
+    # external links need to be handled differently.
+    url_check = urlparse(destination)
+    if known_url_schemes:
+        scheme_known = url_check.scheme in known_url_schemes
+    else:
+        scheme_known = bool(url_check.scheme)
+
+    # TODO check for other supported extensions, such as those specified in
+    # the Sphinx conf.py file but how to access this information?
+    if not scheme_known and ext.replace('.', '') in supported:
+        destination = destination.replace(ext, '')
+
+    # If there's not a url scheme (e.g. 'https' for 'https:...' links),
+    # or there is a scheme but it's not in the list of known_url_schemes,
+    # then assume it's a cross-reference and pass it to Sphinx as an `:any:` ref.
+    return destination, not url_check.fragment and not scheme_known
+
+
+# Whether each commonmark node type is a container
+_container_types = {}
+
+def _is_custom(mdnode):
+    """Whether ``mdnode`` is a custom node standing for a backend token."""
+    return mdnode.t in ('custom_block', 'custom_inline') and bool(mdnode.info)
+
+
+def _is_container(mdnode):
+    """Cached ``mdnode.is_container()``, which matches a regular expression."""
+    try:
+        return _container_types[mdnode.t]
+    except KeyError:
+        container = _container_types[mdnode.t] = mdnode.is_container()
+        return container
+
+
+def _walk(root):
+    """Iterate over the ``(node, entering)`` events of ``root.walker()``.
+
+    Like the walker, the position of the next event is determined before
+    each event is handed out, so handlers may unlink the children of the
+    node they are given.
+    """
+    current, entering = root, True
+    while current is not None:
+        node, node_entering = current, entering
+        if entering and _is_container(node):
+            if node.first_child is not None:
+                current = node.first_child
+            else:
+                entering = False
+        elif node is root:
+            current = None
+        elif node.nxt is None:
+            current, entering = node.parent, False
+        else:
+            current, entering = node.nxt, True
+        yield node, node_entering
+
+
+# Block quote and list markers at the start of a line
+_block_prefix_re = re.compile(
+    r'(?:[ \t]*(?:>|[-+*](?=[ \t])|[0-9]{1,9}[.)](?=[ \t])))+')
+_block_marker_re = re.compile(r'>|[-+*]|[0-9]{1,9}[.)]')
+
+
+def estimate_nesting_depth(text, limit=None):
+    """Estimate the nesting depth of the blocks of markdown ``text``.
+
+    This is the largest number of block quote and list markers opening a
+    line, which is cheap to find before tokenizing. Nesting made by
+    indentation alone is not counted. The scan stops as soon as the depth
+    exceeds ``limit``.
+    """
+    depth = 0
+    for line in text.splitlines():
+        prefix = _block_prefix_re.match(line)
+        if prefix is None:
+            continue
+        depth = max(depth, len(_block_marker_re.findall(prefix.group(0))))
+        if limit is not None and depth > limit:
+            break
+    return depth
+
+
+def _parse_state(name):
+    """Attribute stored in the per-thread state of a parser instance."""
+    def fget(self):
+        return getattr(self._parse_state, name)
+
+    def fset(self, value):
+        setattr(self._parse_state, name, value)
+
+    def fdel(self):
+        delattr(self._parse_state, name)
+
+    return property(fget, fset, fdel)
 
 
 class CommonMarkParser(parsers.Parser):
 
-    """Docutils parser for CommonMark"""
+    """Docutils parser for CommonMark
+
+    All the state of a `parse` call is kept per thread, so a single parser
+    instance can be used to parse documents from several threads at once.
+    """
 
     supported = ('md', 'markdown')
     translate_section_name = None
 
+    inputstring = _parse_state('inputstring')
+    document = _parse_state('document')
+    current_node = _parse_state('current_node')
+    config = _parse_state('config')
+    _level_to_elem = _parse_state('_level_to_elem')
+    _warnings = _parse_state('_warnings')
+
     default_config = {
         'known_url_schemes': None,
+        'markdown_backend': 'commonmark',
+        'max_input_size': None,
+        'max_nesting_depth': None,
+        'max_node_count': None,
+        'max_parse_time': None,
+        'warning_examples': DEFAULT_EXAMPLES,
+        'log_warnings': False,
     }
 
     def __init__(self):
+        self._parse_state = threading.local()
         self._level_to_elem = {}
 
     def parse(self, inputstring, document):
         self.document = document
+        # Mark the document so transforms can cheaply detect markdown sources
+        document.commonmark_parsed = True
         self.current_node = document
-        self.config = self.default_config.copy()
-        try:
-            new_cfg = self.document.settings.env.config.recommonmark_config
-            self.config.update(new_cfg)
-        except AttributeError:
-            pass
+        self.config = self.load_config(document)
+        self._warnings = WarningAggregator(self.config['warning_examples'])
         self.setup_parse(inputstring, document)
         self.setup_sections()
-        parser = Parser()
-        ast = parser.parse(inputstring + '\n')
-        self.convert_ast(ast)
+        self.convert_text(inputstring, document, preparsed=True)
         self.finish_parse()
+        for line in self._warnings.summary():
+            warn(line)
+
+    def parse_fragment(self, inputstring, node, document=None):
+        """Parse a markdown fragment into the docutils element ``node``.
+
+        This is a cheaper `parse` for the many small pieces of markdown a
+        document may hold, such as docstrings, table cells or translated
+        messages. The configuration is loaded once per document instead of
+        once per fragment, and ``node`` gets the converted nodes, headings
+        opening sections inside it. The document is neither marked as
+        markdown nor set up for the parser, but the headings, links and
+        images of the fragment are added to its records if it has them.
+
+        The warnings of all the fragments of a document are aggregated
+        together, and their summary is emitted when fragments of another
+        document are parsed, or by `finish_fragments`.
+
+        Parameters
+        ----------
+        inputstring : str
+            The markdown fragment.
+        node : nodes.Element
+            The element the fragment is converted into.
+        document : nodes.document
+            The document ``node`` belongs to, ``node.document`` by default.
+
+        Raises
+        ------
+        ValueError
+            If ``node`` is not part of a document and none is given.
+        """
+        if document is None:
+            document = node.document
+        if document is None:
+            raise ValueError(
+                'Markdown fragments need a document, pass one for elements '
+                'which are not part of a document')
+        state = self._parse_state
+        # Only a weak reference is kept, the parser must not keep the
+        # document alive
+        previous = getattr(state, 'fragment_document', None)
+        if previous is None or previous() is not document:
+            self.finish_fragments()
+            state.fragment_document = weakref.ref(document)
+            state.fragment_config = self.load_config(document)
+            state.fragment_warnings = WarningAggregator(
+                state.fragment_config['warning_examples'])
+        self.document = document
+        self.config = state.fragment_config
+        self._warnings = state.fragment_warnings
+        self.current_node = node
+        self._level_to_elem = {0: node}
+        try:
+            self.convert_text(inputstring, node)
+        finally:
+            self.document = self.current_node = None
+            self._level_to_elem = {}
 
-    def convert_ast(self, ast):
-        for (node, entering) in ast.walker():
-            fn_prefix = "visit" if entering else "depart"
-            fn_name = "{0}_{1}".format(fn_prefix, node.t.lower())
-            fn_default = "default_{0}".format(fn_prefix)
-            fn = getattr(self, fn_name, None)
-            if fn is None:
-                fn = getattr(self, fn_default)
+    def finish_fragments(self):
+        """Emit the warning summary of the fragments parsed by this thread.
+
+        Call this once all the fragments of a document are parsed.
+        """
+        state = self._parse_state
+        warnings = getattr(state, 'fragment_warnings', None)
+        state.fragment_document = None
+        state.fragment_warnings = None
+        if warnings is not None:
+            for line in warnings.summary():
+                warn(line)
+
+    def load_config(self, document):
+        """Return the configuration for parsing ``document``."""
+        config = self.default_config.copy()
+        try:
+            config.update(document.settings.env.config.recommonmark_config)
+        except AttributeError:
+            pass
+        return config
+
+    def convert_text(self, inputstring, parent, preparsed=False):
+        """Parse ``inputstring`` and convert it into ``parent``.
+
+        The limits of the config are enforced, an input exceeding one of
+        them is only partially converted and gets an error system message.
+        If ``preparsed`` is true, an AST parsed in advance for the document
+        is used when there is one.
+        """
+        try:
+            max_size = self.config['max_input_size']
+            if max_size is not None and len(inputstring) > max_size:
+                raise ResourceLimitExceeded(
+                    'max_input_size exceeded ({0})'.format(max_size))
+            # Deep nesting is slow to tokenize, check it before
+            max_depth = self.config['max_nesting_depth']
+            if (max_depth is not None and
+                    estimate_nesting_depth(inputstring, max_depth) > max_depth):
+                raise ResourceLimitExceeded(
+                    'max_nesting_depth exceeded ({0})'.format(max_depth))
+            deadline = None
+            if self.config['max_parse_time'] is not None:
+                deadline = time.time() + self.config['max_parse_time']
+            backend_name = self.config['markdown_backend']
+            ast = None
+            if preparsed:
+                # Serial Sphinx builds may have parsed the document in advance
+                ast = take_preparsed(self.document, inputstring, backend_name)
+            if ast is None:
+                backend = get_backend(backend_name)
+                if (deadline is not None and
+                        getattr(backend, 'supports_deadline', False)):
+                    ast = backend.parse(inputstring + '\n', deadline=deadline)
+                else:
+                    ast = backend.parse(inputstring + '\n')
+            # The AST is private to this call, so let the conversion free it as
+            # it goes instead of keeping it alive next to the whole docutils
+            # tree.
+            self.convert_ast(ast, release=True, deadline=deadline)
+        except ResourceLimitExceeded as error:
+            msg = self.document.reporter.error(
+                'Markdown input not fully converted: {0}'.format(error))
+            parent.append(msg)
+
+    def report_warning(self, kind, message, mdnode=None):
+        """Report a conversion warning of the given ``kind``.
+
+        Only the first ``warning_examples`` warnings of each kind are issued
+        with `warnings.warn`, followed by a summary at the end of the
+        document. When ``log_warnings`` is set in Sphinx builds, the warning
+        is logged by Sphinx instead, with the location of ``mdnode``, and
+        turned into an error by ``-W`` like other Sphinx warnings.
+        """
+        env = getattr(self.document.settings, 'env', None)
+        if env is not None and self.config['log_warnings']:
+            location = (env.docname, mdnode and self._get_line(mdnode))
+            logger.warning(message, location=location,
+                           type='recommonmark', subtype=kind)
+        elif self._warnings.add(kind, self.document.get('source')):
+            warn(message)
+
+    def convert_ast(self, ast, release=False, deadline=None):
+        """Convert a commonmark AST to docutils nodes.
+
+        If ``release`` is true, each commonmark node is unlinked from the AST
+        once it has been handled, so already converted subtrees can be garbage
+        collected during the conversion. The AST is left empty afterwards.
+
+        The ``max_nesting_depth`` and ``max_node_count`` limits of the config,
+        and the ``deadline`` timestamp if given, are checked along the way;
+        `ResourceLimitExceeded` is raised when one of them is exceeded.
+        """
+        max_depth = self.config.get('max_nesting_depth')
+        max_count = self.config.get('max_node_count')
+        depth = count = 0
+        if deadline is not None and time.time() > deadline:
+            raise ResourceLimitExceeded('max_parse_time exceeded ({0}s)'.format(
+                self.config.get('max_parse_time')))
+        # Handlers are looked up on the instance once per call, so overrides
+        # of the instance and later changes of the class are honoured
+        handlers = {}
+        for (node, entering) in _walk(ast):
+            if entering:
+                count += 1
+                if max_count is not None and count > max_count:
+                    raise ResourceLimitExceeded(
+                        'max_node_count exceeded ({0})'.format(max_count))
+                # Check the clock only every so often, it is comparatively slow
+                if deadline is not None and not count % 1000 and (
+                        time.time() > deadline):
+                    raise ResourceLimitExceeded(
+                        'max_parse_time exceeded ({0}s)'.format(
+                            self.config.get('max_parse_time')))
+            container = _is_container(node)
+            if container:
+                if entering:
+                    # The document node itself is not counted
+                    depth += 1
+                    if max_depth is not None and depth - 1 > max_depth:
+                        raise ResourceLimitExceeded(
+                            'max_nesting_depth exceeded ({0})'.format(
+                                max_depth))
+                else:
+                    depth -= 1
+            try:
+                fn = handlers[node.t, entering]
+            except KeyError:
+                fn = handlers[node.t, entering] = self._get_handler(
+                    node.t, entering)
             fn(node)
+            # Containers are released on depart, leaves after their only visit.
+            # The walker has already moved on to the next node at this point.
+            if release and (not entering or not container):
+                self._release_node(node)
+
+    def _get_handler(self, node_type, entering):
+        """Return the method handling the entering or exit of a node."""
+        prefix = 'visit' if entering else 'depart'
+        fn = getattr(self, '{0}_{1}'.format(prefix, node_type.lower()), None)
+        if fn is None:
+            fn = getattr(self, 'default_{0}'.format(prefix))
+        return fn
 
     # Node type enter/exit handlers
     def default_visit(self, mdnode):
-        pass
+        if _is_custom(mdnode):
+            self.visit_custom(mdnode)
 
     def default_depart(self, mdnode):
         """Default node depart handler
@@ -69,10 +395,12 @@ class CommonMarkParser(parsers.Parser):
         then we should make sure to back up to it's parent element when the node
         is exited.
         """
-        if mdnode.is_container():
+        if _is_container(mdnode) and mdnode.t != 'document':
             fn_name = 'visit_{0}'.format(mdnode.t)
-            if not hasattr(self, fn_name):
-                warn("Container node skipped: type={0}".format(mdnode.t))
+            if not hasattr(self, fn_name) and not _is_custom(mdnode):
+                self.report_warning(
+                    'container', "Container node skipped: type={0}".format(
+                        mdnode.t), mdnode)
             else:
                 self.current_node = self.current_node.parent
 
@@ -95,22 +423,26 @@ class CommonMarkParser(parsers.Parser):
         # for heading.
         self.current_node = title_node
 
-    def depart_heading(self, _):
+    def depart_heading(self, mdnode):
         """Finish establishing section
 
         Wrap up title node, but stick in the section node. Add the section names
-        based on all the text nodes added to the title.
+        based on all the text nodes added to the title, and record the heading
+        in the heading index of the document.
         """
         assert isinstance(self.current_node, nodes.title)
         # The title node has a tree of text nodes, use the whole thing to
         # determine the section id and names
-        text = self.current_node.astext()
+        title = text = self.current_node.astext()
         if self.translate_section_name:
             text = self.translate_section_name(text)
         name = nodes.fully_normalize_name(text)
         section = self.current_node.parent
         section['names'].append(name)
         self.document.note_implicit_target(section, section)
+        anchor = section['ids'][0] if section['ids'] else None
+        self._record('commonmark_headings',
+                     (mdnode.level, title, anchor, section.line))
         self.current_node = section
 
     def visit_text(self, mdnode):
@@ -144,23 +476,9 @@ class CommonMarkParser(parsers.Parser):
 
     def visit_link(self, mdnode):
         ref_node = nodes.reference()
-        # Check destination is supported for cross-linking and remove extension
-        destination = mdnode.destination
-        _, ext = splitext(destination)
-
-        # Check if the destination starts with a url scheme, since internal and
-        # external links need to be handled differently.
-        url_check = urlparse(destination)
-        known_url_schemes = self.config.get('known_url_schemes')
-        if known_url_schemes:
-            scheme_known = url_check.scheme in known_url_schemes
-        else:
-            scheme_known = bool(url_check.scheme)
-
-        # TODO check for other supported extensions, such as those specified in
-        # the Sphinx conf.py file but how to access this information?
-        if not scheme_known and ext.replace('.', '') in self.supported:
-            destination = destination.replace(ext, '')
+        destination, is_xref = classify_link(
+            mdnode.destination, self.config.get('known_url_schemes'),
+            self.supported)
         ref_node['refuri'] = destination
         # TODO okay, so this is acutally not always the right line number, but
         # these mdnodes won't have sourcepos on them for whatever reason. This
@@ -170,10 +488,9 @@ class CommonMarkParser(parsers.Parser):
             ref_node['title'] = mdnode.title
         next_node = ref_node
 
-        # If there's not a url scheme (e.g. 'https' for 'https:...' links),
-        # or there is a scheme but it's not in the list of known_url_schemes,
-        # then assume it's a cross-reference and pass it to Sphinx as an `:any:` ref.
-        if not url_check.fragment and not scheme_known:
+        if is_xref:
+            # Resolved as `any`, or as `doc` and `ref` by
+            # recommonmark.references once all documents are known
             wrap_node = addnodes.pending_xref(
                 reftarget=unquote(destination),
                 reftype='any',
@@ -240,6 +557,7 @@ class CommonMarkParser(parsers.Parser):
         if text.endswith('\n'):
             text = text[:-1]
         node = nodes.literal_block(text, text, **kwargs)
+        node.line = self._get_line(mdnode)
         self.current_node.append(node)
 
     def visit_block_quote(self, mdnode):
@@ -264,9 +582,33 @@ class CommonMarkParser(parsers.Parser):
     def visit_thematic_break(self, _):
         self.current_node.append(nodes.transition())
 
+    def visit_custom(self, mdnode):
+        """Keep a custom node of a backend token as a generic node.
+
+        Custom nodes with a token type in ``info`` are made by backends for
+        tokens without a commonmark counterpart. They become a container or
+        an inline element their children are converted into, and a warning
+        naming the token type is reported.
+        """
+        node = (nodes.container() if mdnode.t == 'custom_block'
+                else nodes.inline())
+        line = self._get_line(mdnode)
+        self.document.reporter.warning(
+            'Unsupported markdown token "{0}", converted to a generic '
+            'node'.format(mdnode.info or mdnode.t), line=line)
+        node.line = line
+        if mdnode.info:
+            node['classes'].append(nodes.make_id(mdnode.info))
+        if mdnode.literal:
+            node.append(nodes.Text(mdnode.literal, mdnode.literal))
+        self.current_node.append(node)
+        self.current_node = node
+
     # Section handling
     def setup_sections(self):
         self._level_to_elem = {0: self.document}
+        # (level, title, anchor id, source line) of every heading
+        self.document.commonmark_headings = []
 
     def add_section(self, section, level):
         parent_level = max(
@@ -287,6 +629,33 @@ class CommonMarkParser(parsers.Parser):
     def is_section_level(self, level, section):
         return self._level_to_elem.get(level, None) == section
 
+    def _record(self, name, item):
+        """Add ``item`` to the ``name`` records of the document, if it has them.
+
+        Documents set up by `parse` have them, other documents only get
+        fragments parsed into them by `parse_fragment`.
+        """
+        records = getattr(self.document, name, None)
+        if records is not None:
+            records.append(item)
+
+    @staticmethod
+    def _release_node(mdnode):
+        """Unlink a fully handled node from the commonmark AST.
+
+        Nodes are handled in document order, so any previous siblings have
+        already been released and ``mdnode`` is the first child of its parent.
+        """
+        parent = mdnode.parent
+        if parent is not None:
+            parent.first_child = mdnode.nxt
+            if mdnode.nxt is None:
+                parent.last_child = None
+        if mdnode.nxt is not None:
+            mdnode.nxt.prv = None
+        mdnode.parent = mdnode.nxt = mdnode.prv = None
+        mdnode.first_child = mdnode.last_child = None
+
     def _get_line(self, mdnode):
         while mdnode:
             if mdnode.sourcepos:
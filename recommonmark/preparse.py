@@ -0,0 +1,168 @@
+"""Parse markdown sources ahead of time in serial Sphinx builds.
+
+When ``preparse_workers`` is set in ``recommonmark_config``, the markdown
+documents about to be read are handed to a pool of worker processes at
+``env-before-read-docs``. The workers run the markdown backend, which is the
+bulk of the parsing time, and `CommonMarkParser.parse` then only converts the
+resulting AST to docutils nodes when Sphinx reaches each document.
+
+A document is parsed in line as usual whenever no usable result is available:
+its job has not started yet, it failed, or the text read by Sphinx differs
+from the file the worker read, for instance because a ``source-read`` handler
+changed it. Parallel builds (``-j``) already spread parsing over processes
+and are left alone.
+"""
+
+import hashlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import splitext
+
+from commonmark.node import Node
+
+from .backends import get_backend
+
+__all__ = ['Preparser', 'flatten_ast', 'rebuild_ast', 'setup']
+
+_LINKS = ('parent', 'first_child', 'last_child', 'prv', 'nxt')
+
+
+def flatten_ast(ast):
+    """Return a picklable list of the attributes of every node of ``ast``.
+
+    Links between nodes are replaced by indices in the list, which keeps
+    pickling from recursing along long chains of siblings.
+    """
+    mdnodes = [node for node, entering in ast.walker() if entering]
+    index = dict((id(node), i) for i, node in enumerate(mdnodes))
+    flat = []
+    for node in mdnodes:
+        attrs = dict(vars(node))
+        for name in _LINKS:
+            linked = attrs[name]
+            attrs[name] = None if linked is None else index[id(linked)]
+        flat.append(attrs)
+    return flat
+
+
+def rebuild_ast(flat):
+    """Rebuild the AST flattened by `flatten_ast` and return its root."""
+    mdnodes = [Node.__new__(Node) for _ in flat]
+    for node, attrs in zip(mdnodes, flat):
+        node.__dict__.update(attrs)
+        for name in _LINKS:
+            linked = attrs[name]
+            setattr(node, name, None if linked is None else mdnodes[linked])
+    return mdnodes[0]
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _parse_file(path, encoding, backend_name, max_size):
+    """Worker job: parse the markdown file at ``path``."""
+    with io.open(path, encoding=encoding) as fin:
+        text = fin.read()
+    if max_size is not None and len(text) > max_size:
+        return None
+    ast = get_backend(backend_name).parse(text + '\n')
+    return _digest(text), flatten_ast(ast)
+
+
+class Preparser(object):
+
+    """Pool of worker processes parsing markdown documents in advance.
+
+    ``hits`` and ``misses`` count the documents whose AST was, or could not
+    be, taken from a worker.
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ProcessPoolExecutor(max_workers)
+        self.jobs = {}
+        self.hits = self.misses = 0
+
+    def submit(self, docname, path, encoding, backend_name, max_size=None):
+        self.jobs[docname] = (backend_name, self.executor.submit(
+            _parse_file, path, encoding, backend_name, max_size))
+
+    def take(self, docname, inputstring, backend_name):
+        """Return the AST parsed for ``docname``, or None.
+
+        Waits for the job if a worker is already busy with it, and cancels
+        it if it has not started yet, since parsing in line is faster then.
+        """
+        job = self.jobs.pop(docname, None)
+        if job is None:
+            return None
+        job_backend, future = job
+        result = None
+        if job_backend == backend_name and not future.cancel():
+            try:
+                result = future.result()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        if result is None or result[0] != _digest(inputstring):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return rebuild_ast(result[1])
+
+    def shutdown(self):
+        for _, future in self.jobs.values():
+            future.cancel()
+        self.jobs.clear()
+        self.executor.shutdown(wait=False)
+
+
+def take_preparsed(document, inputstring, backend_name):
+    """Return the AST parsed in advance for ``document``, or None."""
+    env = getattr(document.settings, 'env', None)
+    preparser = getattr(getattr(env, 'app', None),
+                        'recommonmark_preparser', None)
+    if preparser is None:
+        return None
+    return preparser.take(env.docname, inputstring, backend_name)
+
+
+def env_before_read_docs(app, env, docnames):
+    from .parser import CommonMarkParser
+
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    workers = config.get('preparse_workers')
+    backend_name = config.get('markdown_backend', 'commonmark')
+    if (not workers or app.parallel > 1 or
+            config.get('max_parse_time') is not None or
+            not isinstance(backend_name, str)):
+        return
+    if workers == 'auto':
+        workers = multiprocessing.cpu_count()
+    paths = []
+    for docname in docnames:
+        path = env.doc2path(docname)
+        if splitext(path)[1][1:] in CommonMarkParser.supported:
+            paths.append((docname, path))
+    if not paths:
+        return
+    shutdown(app)
+    preparser = app.recommonmark_preparser = Preparser(workers)
+    for docname, path in paths:
+        preparser.submit(docname, path, app.config.source_encoding,
+                         backend_name, config.get('max_input_size'))
+
+
+def shutdown(app, *args):
+    preparser = getattr(app, 'recommonmark_preparser', None)
+    if preparser is not None:
+        preparser.shutdown()
+        # Keep the statistics around, but stop serving results
+        app.recommonmark_preparse_stats = (preparser.hits, preparser.misses)
+        app.recommonmark_preparser = None
+
+
+def setup(app):
+    app.connect('env-before-read-docs', env_before_read_docs)
+    app.connect('env-updated', shutdown)
+    app.connect('build-finished', shutdown)
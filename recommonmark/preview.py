@@ -0,0 +1,55 @@
+"""Fast HTML preview of markdown, bypassing docutils.
+
+The commonmark AST is rendered straight to an HTML fragment. Links follow the
+same rules as `CommonMarkParser`: the extension of linked markdown documents
+is removed and ``known_url_schemes`` decides which links are external.
+
+Compared to the docutils pipeline, the preview does not wrap headings in
+sections, does not run AutoStructify or any other transform, renders
+cross-references as plain links and outputs a fragment instead of a full
+HTML page.
+"""
+
+from commonmark import Parser
+from commonmark.render.html import HtmlRenderer
+from docutils import nodes
+
+from .parser import CommonMarkParser, classify_link
+
+__all__ = ['PreviewRenderer', 'render_preview']
+
+
+class PreviewRenderer(HtmlRenderer):
+
+    """commonmark HTML renderer applying the link rules of recommonmark"""
+
+    def __init__(self, known_url_schemes=None, options=None):
+        HtmlRenderer.__init__(self, dict(options or {}))
+        self.known_url_schemes = known_url_schemes
+
+    def link(self, node, entering):
+        if entering:
+            node.destination, _ = classify_link(
+                node.destination, self.known_url_schemes,
+                CommonMarkParser.supported)
+        HtmlRenderer.link(self, node, entering)
+
+    def heading(self, node, entering):
+        if not entering:
+            HtmlRenderer.heading(self, node, entering)
+            return
+        # Use the same anchor as the section docutils would create
+        text = []
+        for child, child_entering in node.walker():
+            if child_entering and child.t in ('text', 'code'):
+                text.append(child.literal)
+        attrs = self.attrs(node)
+        attrs.append(['id', nodes.make_id(
+            nodes.fully_normalize_name(''.join(text)))])
+        self.cr()
+        self.tag('h' + str(node.level), attrs)
+
+
+def render_preview(source, known_url_schemes=None):
+    """Render markdown ``source`` to an HTML fragment."""
+    return PreviewRenderer(known_url_schemes).render(Parser().parse(source))
@@ -0,0 +1,208 @@
+"""Resolve the cross-references of markdown documents cheaply.
+
+`CommonMarkParser` emits ``any`` references for scheme-less links. Once all
+documents are read, `MarkdownReferences` turns the ones whose target is
+either a document of the project or a label of the standard domain into
+``std:doc`` or ``std:ref`` references, with the same output the ``any`` role
+gives them. Only the remaining ones, including targets which are both a
+document and a label, go through the ``any`` role, which asks every domain
+about the target.
+
+The same link targets tend to appear in many documents, so the outcome of
+resolving a target from a given directory is also kept in a
+`ResolutionCache` for the rest of the build. The cache is emptied whenever
+documents are read, so incremental builds never see stale outcomes.
+"""
+
+import posixpath
+from os.path import splitext
+
+from docutils import nodes
+from sphinx import addnodes
+from sphinx.environment import NoUri
+from sphinx.transforms import SphinxTransform
+from sphinx.transforms.post_transforms import ReferencesResolver
+from sphinx.util import docname_join, logging
+from sphinx.util.nodes import make_refnode
+
+__all__ = ['MarkdownReferences', 'ResolutionCache', 'get_resolution_cache',
+           'setup']
+
+logger = logging.getLogger(__name__)
+
+# Outcome of references left for Sphinx to resolve
+DEFER = 'defer'
+# Outcome of references resolved by a missing-reference handler
+HANDLED = 'handled'
+
+
+def is_markdown_xref(node):
+    """Tell whether ``node`` is a cross-reference made from a markdown link."""
+    return (not node.get('refdomain') and node.get('reftype') == 'any' and
+            node.get('refexplicit') and len(node) == 1 and
+            isinstance(node[0], nodes.reference) and 'refuri' in node[0])
+
+
+class ResolutionCache(object):
+
+    """Outcomes of markdown cross-references resolved during a build.
+
+    Outcomes are keyed by ``(directory of the referring document, reftype,
+    reftarget)`` and are one of ``('doc', docname)``, ``('ref', docname,
+    labelid)``, None for unresolved references, `HANDLED` for references
+    resolved by a ``missing-reference`` handler, or `DEFER` for references
+    which Sphinx resolves by itself.
+    """
+
+    def __init__(self):
+        self.outcomes = {}
+        self.hits = self.misses = 0
+
+    def clear(self):
+        self.outcomes.clear()
+
+
+def get_resolution_cache(app):
+    """Return the `ResolutionCache` of the build run by ``app``."""
+    cache = getattr(app, 'recommonmark_resolution_cache', None)
+    if cache is None:
+        cache = app.recommonmark_resolution_cache = ResolutionCache()
+    return cache
+
+
+class MarkdownReferences(SphinxTransform):
+
+    """Resolve the cross-references of markdown links.
+
+    This runs before Sphinx resolves references, when all documents and
+    labels are known. ``any`` references to documents or labels become
+    ``doc`` or ``ref`` references, and references whose outcome is cached
+    are resolved directly, with the same nodes and warnings Sphinx would
+    produce.
+    """
+
+    default_priority = 5
+
+    def apply(self):
+        from .parser import CommonMarkParser
+
+        source = self.document.get('source') or ''
+        if splitext(source)[1][1:] not in CommonMarkParser.supported:
+            return
+        labels = self.env.get_domain('std').data['anonlabels']
+        cache = get_resolution_cache(self.app)
+        for node in self.document.traverse(addnodes.pending_xref):
+            if not is_markdown_xref(node):
+                continue
+            docname = docname_join(node.get('refdoc', self.env.docname),
+                                   node['reftarget'])
+            is_doc = docname in self.env.all_docs
+            # Labels are case insensitive, like with the ref role
+            target = node['reftarget'].lower()
+            # Targets which are both are left to the any role, which warns
+            # about the ambiguity
+            if is_doc and target not in labels:
+                node['refdomain'] = 'std'
+                node['reftype'] = 'doc'
+            elif target in labels and not is_doc:
+                node['refdomain'] = 'std'
+                node['reftype'] = 'ref'
+                node['reftarget'] = target
+            self.resolve(node, cache)
+
+    def resolve(self, node, cache):
+        """Resolve ``node`` from the cache, looking its outcome up if needed.
+
+        ``doc`` and ``ref`` targets are looked up like the standard domain
+        does. Otherwise the ``missing-reference`` event decides whether the
+        reference is unresolved, or left for Sphinx to resolve. The ``any``
+        role and the handlers of the event are called at most once for each
+        reference.
+        """
+        typ, target = node['reftype'], node['reftarget']
+        refdoc = node.get('refdoc', self.env.docname)
+        key = (posixpath.dirname(refdoc), typ, target)
+        contnode = node[0].deepcopy()
+        newnode = None
+        try:
+            if key in cache.outcomes:
+                cache.hits += 1
+                outcome = cache.outcomes[key]
+                if outcome == HANDLED:
+                    # Handlers may resolve each reference differently
+                    newnode = self.app.emit_firstresult(
+                        'missing-reference', self.env, node, contnode)
+            else:
+                cache.misses += 1
+                outcome, newnode = self.lookup(refdoc, node, contnode)
+                cache.outcomes[key] = outcome
+            if outcome == DEFER and newnode is None:
+                return
+            if outcome not in (None, HANDLED, DEFER):
+                if outcome[0] == 'doc':
+                    caption = node.astext()
+                    newnode = make_refnode(
+                        self.app.builder, refdoc, outcome[1], None,
+                        nodes.inline(caption, caption, classes=['doc']))
+                    role = 'doc'
+                else:
+                    newnode = self.env.get_domain('std').build_reference_node(
+                        refdoc, self.app.builder, outcome[1], outcome[2],
+                        node.astext(), 'ref')
+                    role = 'std:ref'
+                # The classes the any role adds for the role it resolved to
+                newnode[0]['classes'].extend(
+                    [role.split(':')[0], role.replace(':', '-')])
+            if newnode is None:
+                domain = self.env.domains.get(node['refdomain'])
+                ReferencesResolver(self.document).warn_missing_reference(
+                    refdoc, typ, target, node, domain)
+                newnode = contnode
+        except NoUri:
+            newnode = contnode
+        node.replace_self(newnode)
+
+    def lookup(self, refdoc, node, contnode):
+        """Return the outcome of ``node`` and the node it resolves to.
+
+        The node is only given for references resolved by the ``any`` role
+        or by a ``missing-reference`` handler, and is None otherwise.
+        """
+        typ, target = node['reftype'], node['reftarget']
+        if typ == 'doc':
+            docname = docname_join(refdoc, target)
+            if docname in self.env.all_docs:
+                return ('doc', docname), None
+        elif typ == 'ref':
+            std = self.env.get_domain('std')
+            docname, labelid = std.data['anonlabels'].get(target, ('', ''))
+            if docname:
+                return ('ref', docname, labelid), None
+        else:
+            resolver = ReferencesResolver(self.document)
+            newnode = resolver.resolve_anyref(refdoc, node, contnode)
+            if newnode is not None:
+                return DEFER, newnode
+        newnode = self.app.emit_firstresult('missing-reference', self.env,
+                                            node, contnode)
+        if newnode is not None:
+            return HANDLED, newnode
+        return None, None
+
+
+def env_updated(app, env):
+    get_resolution_cache(app).clear()
+
+
+def build_finished(app, exception):
+    cache = get_resolution_cache(app)
+    total = cache.hits + cache.misses
+    if total:
+        logger.verbose('markdown cross-references: %d resolved, %.0f%% from '
+                       'the cache', total, 100.0 * cache.hits / total)
+
+
+def setup(app):
+    app.add_post_transform(MarkdownReferences)
+    app.connect('env-updated', env_updated)
+    app.connect('build-finished', build_finished)
@@ -0,0 +1,163 @@
+"""Aggregate the warnings reported for markdown documents.
+
+Generated documentation can produce the same warning, such as an unresolved
+reference, a huge number of times. Instead of printing each of them, the
+warnings are counted by kind and by document, only the first
+``warning_examples`` of each kind are printed, and a summary of the rest is
+printed at the end of the build.
+
+`CommonMarkParser` does this for the warnings of each document it parses.
+In Sphinx builds, setting ``warning_examples`` in ``recommonmark_config``
+also applies it to every warning located in a markdown document, including
+those of Sphinx itself and of other extensions, across the whole build. The
+summary lines are logged as Sphinx warnings, so they are counted, and turned
+into errors by ``-W``, like the others. Setting ``warning_log`` writes all of
+them, printed or not, to ``recommonmark_warnings.log`` in the output
+directory.
+"""
+
+import io
+import os
+from collections import defaultdict
+from os.path import splitext
+
+__all__ = ['WarningAggregator', 'setup']
+
+LOG_FILE = 'recommonmark_warnings.log'
+DEFAULT_EXAMPLES = 10
+
+
+class WarningAggregator(object):
+
+    """Count warnings by kind and location bucket.
+
+    Parameters
+    ----------
+    max_examples : int
+        Number of warnings of each kind to show, None to show all of them.
+    """
+
+    def __init__(self, max_examples=DEFAULT_EXAMPLES):
+        self.max_examples = max_examples
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.totals = defaultdict(int)
+
+    def add(self, kind, bucket):
+        """Count a warning and return whether it should be shown."""
+        self.counts[kind][bucket] += 1
+        self.totals[kind] += 1
+        return (self.max_examples is None or
+                self.totals[kind] <= self.max_examples)
+
+    def summary(self, top=3):
+        """Return one line for each kind of which warnings were not shown."""
+        lines = []
+        for kind in sorted(self.totals):
+            total = self.totals[kind]
+            if self.max_examples is None or total <= self.max_examples:
+                continue
+            buckets = sorted(self.counts[kind].items(),
+                             key=lambda item: (-item[1], item[0]))
+            lines.append(
+                '{0} more {1} warnings were not shown, {2} in total in {3} '
+                'location{4}, mostly in {5}'.format(
+                    total - self.max_examples, kind, total, len(buckets),
+                    '' if len(buckets) == 1 else 's',
+                    ', '.join('{0} ({1})'.format(bucket, count)
+                              for bucket, count in buckets[:top])))
+        return lines
+
+
+class AggregatingFilter(object):
+
+    """Logging filter applying a `WarningAggregator` to markdown documents.
+
+    It is installed on the Sphinx warning handler after the filter which
+    turns the location of records into a ``path:line`` string. Warnings
+    logged by parallel readers are handled by the main process, so the
+    counts cover the whole build.
+    """
+
+    def __init__(self, max_examples, log_path=None):
+        from .parser import CommonMarkParser
+
+        self.aggregator = WarningAggregator(max_examples)
+        self.suffixes = CommonMarkParser.supported
+        self.log_path = log_path
+        self.log = None
+
+    def filter(self, record):
+        location = getattr(record, 'location', None)
+        if not location:
+            return True
+        path, _, line = location.rpartition(':')
+        if not line.isdigit():
+            path = location
+        if splitext(path)[1][1:] not in self.suffixes:
+            return True
+        kind = getattr(record, 'type', None) or 'docutils'
+        subtype = getattr(record, 'subtype', None)
+        if subtype:
+            kind = '{0}.{1}'.format(kind, subtype)
+        if self.log_path is not None:
+            if self.log is None:
+                self.log = io.open(self.log_path, 'w', encoding='utf-8')
+            self.log.write(u'{0}: {1}\n'.format(location, record.getMessage()))
+        return self.aggregator.add(kind, path)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+def _warning_handler():
+    import logging
+    from sphinx.util.logging import NAMESPACE, WarningLogRecordTranslator
+
+    for handler in logging.getLogger(NAMESPACE).handlers:
+        for i, filter_ in enumerate(handler.filters):
+            if isinstance(filter_, WarningLogRecordTranslator):
+                return handler, i + 1
+    return None, None
+
+
+def builder_inited(app):
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    # Only warnings of the parser are aggregated unless asked for
+    max_examples = config.get('warning_examples')
+    log_path = None
+    if config.get('warning_log'):
+        if not os.path.isdir(app.outdir):
+            os.makedirs(app.outdir)
+        log_path = os.path.join(app.outdir, LOG_FILE)
+    if max_examples is None and log_path is None:
+        return
+    handler, position = _warning_handler()
+    if handler is None:
+        return
+    app.recommonmark_warning_filter = AggregatingFilter(
+        max_examples, log_path)
+    handler.filters.insert(position, app.recommonmark_warning_filter)
+
+
+def build_finished(app, exception):
+    from sphinx.util import logging
+
+    filter_ = getattr(app, 'recommonmark_warning_filter', None)
+    if filter_ is None:
+        return
+    handler, _ = _warning_handler()
+    if handler is not None and filter_ in handler.filters:
+        handler.removeFilter(filter_)
+    filter_.close()
+    app.recommonmark_warning_filter = None
+    if exception is None:
+        logger = logging.getLogger(__name__)
+        for line in filter_.aggregator.summary():
+            logger.warning(line, type='recommonmark', subtype='summary')
+
+
+def setup(app):
+    app.connect('builder-inited', builder_inited)
+    app.connect('build-finished', build_finished)
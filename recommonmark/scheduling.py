@@ -0,0 +1,126 @@
+"""Balance the documents read by parallel readers.
+
+Sphinx cuts the list of documents to read into chunks of the same number of
+documents, and hands them out in order to ``-j`` reader processes. A chunk
+holding a few huge generated documents then keeps one reader busy long
+after the others are done. At ``env-before-read-docs``, this module
+reorders the list so that the chunks Sphinx cuts have about the same cost,
+and the most expensive ones are handed out first.
+
+The cost of a document is the time it took to read in the previous build,
+remembered in the environment, or else an estimate from the size of its
+source file. The order of all the documents of the project changes, not
+only of the markdown ones, so the scheduling is only done when
+``schedule_parallel_reads`` is enabled in ``recommonmark_config``.
+"""
+
+import heapq
+import os
+import time
+
+from sphinx.util.parallel import make_chunks
+
+__all__ = ['get_read_times', 'schedule', 'setup']
+
+
+def get_read_times(env):
+    """Return the ``{docname: seconds}`` read times of the last builds."""
+    if not hasattr(env, 'recommonmark_read_times'):
+        env.recommonmark_read_times = {}
+    return env.recommonmark_read_times
+
+
+def schedule(docnames, costs, nproc):
+    """Order ``docnames`` for the chunks of a read with ``nproc`` readers.
+
+    The documents are spread over chunks of the sizes ``make_chunks`` will
+    cut, the most expensive first, each going to the chunk with the lowest
+    total cost that still has room. The chunks are then laid out from the
+    most to the least expensive one.
+
+    Parameters
+    ----------
+    docnames : list of str
+        The documents to read.
+    costs : dict
+        The estimated cost of each document.
+    nproc : int
+        The number of reader processes.
+    """
+    chunk_sizes = [len(chunk) for chunk in
+                   make_chunks(list(range(len(docnames))), nproc)]
+    chunks = [[] for _ in chunk_sizes]
+    loads = [0.0] * len(chunks)
+    heap = [(0.0, i) for i in range(len(chunks))]
+    for docname in sorted(docnames, key=lambda name: (-costs[name], name)):
+        load, i = heapq.heappop(heap)
+        chunks[i].append(docname)
+        loads[i] = load + costs[docname]
+        if len(chunks[i]) < chunk_sizes[i]:
+            heapq.heappush(heap, (loads[i], i))
+    order = sorted(range(len(chunks)), key=lambda i: (-loads[i], i))
+    return [docname for i in order for docname in chunks[i]]
+
+
+def estimate_costs(env, docnames):
+    """Return the estimated read time of each of ``docnames``.
+
+    Documents read before cost their last read time. The others cost their
+    source size, converted to time at the rate of the documents read before.
+    """
+    read_times = get_read_times(env)
+    sizes = {}
+    for docname in docnames:
+        try:
+            sizes[docname] = os.path.getsize(env.doc2path(docname))
+        except OSError:
+            sizes[docname] = 0
+    timed = [docname for docname in docnames if docname in read_times]
+    timed_size = sum(sizes[docname] for docname in timed)
+    rate = 1.0
+    if timed_size:
+        rate = sum(read_times[docname] for docname in timed) / timed_size
+    return dict((docname, read_times.get(docname, sizes[docname] * rate))
+                for docname in docnames)
+
+
+def env_before_read_docs(app, env, docnames):
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    # Sphinx only reads in parallel when there are more than 5 documents
+    if (app.parallel <= 1 or len(docnames) <= 5 or
+            not config.get('schedule_parallel_reads')):
+        return
+    docnames[:] = schedule(docnames, estimate_costs(env, docnames),
+                           app.parallel)
+
+
+def source_read(app, docname, source):
+    starts = app.__dict__.setdefault('recommonmark_read_starts', {})
+    starts[docname] = time.time()
+
+
+def doctree_read(app, doctree):
+    starts = getattr(app, 'recommonmark_read_starts', {})
+    start = starts.pop(app.env.docname, None)
+    if start is not None:
+        get_read_times(app.env)[app.env.docname] = time.time() - start
+
+
+def purge_doc(app, env, docname):
+    get_read_times(env).pop(docname, None)
+
+
+def merge_info(app, env, docnames, other):
+    read_times = get_read_times(env)
+    other_read_times = get_read_times(other)
+    for docname in docnames:
+        if docname in other_read_times:
+            read_times[docname] = other_read_times[docname]
+
+
+def setup(app):
+    app.connect('env-before-read-docs', env_before_read_docs)
+    app.connect('source-read', source_read)
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
@@ -16,47 +16,221 @@ try:
 except ImportError:
     pass
 
+import argparse
+import io
+import pickle
+import sys
+
+import docutils
+from docutils import SettingsSpec, transforms, utils
 from docutils.core import publish_cmdline, default_description
+from docutils.readers import standalone
+
+import recommonmark
+from recommonmark.cache import DiskCache, make_key
 from recommonmark.parser import CommonMarkParser
 
 
+def _distribution_version(name):
+    try:
+        from importlib import metadata
+        return metadata.version(name)
+    except ImportError:
+        import pkg_resources
+        return pkg_resources.get_distribution(name).version
+
+
+# Settings which change the doctree produced by the reader and the parser
+PARSER_SETTINGS = ('id_prefix', 'auto_id_prefix', 'language_code',
+                   'tab_width', 'input_encoding', 'report_level',
+                   'halt_level')
+
+
+class CachingReader(standalone.Reader):
+
+    """Standalone reader which can cache parsed doctrees on disk
+
+    The cache is enabled with the ``--doctree-cache`` option. Entries are
+    keyed on the source, the parser, the settings which affect parsing and
+    the library versions. On a hit, the cached doctree goes through the
+    transforms and the writer directly, and the messages the reporter
+    emitted while parsing it are emitted again.
+    """
+
+    messages = None
+
+    settings_spec = standalone.Reader.settings_spec + (
+        'Doctree Cache Options',
+        None,
+        (('Cache parsed doctrees in <directory> and reuse them while the '
+          'source and the parser are unchanged.',
+          ['--doctree-cache'],
+          {'metavar': '<directory>'}),
+         ('Maximum size of the doctree cache in bytes.  Default: 100 MB.',
+          ['--doctree-cache-size'],
+          {'type': 'int', 'metavar': '<bytes>',
+           'default': 100 * 1024 * 1024}),))
+
+    def parse(self):
+        directory = getattr(self.settings, 'doctree_cache', None)
+        if not directory:
+            standalone.Reader.parse(self)
+            return
+        cache = DiskCache(directory, self.settings.doctree_cache_size)
+        parser_class = type(self.parser)
+        key = make_key(
+            self.input, self.source.source_path,
+            parser_class.__module__, parser_class.__name__,
+            sorted(getattr(self.parser, 'default_config', {}).items()),
+            [getattr(self.settings, name, None) for name in PARSER_SETTINGS],
+            recommonmark.__version__, _distribution_version('commonmark'),
+            docutils.__version__, sys.version_info[:2])
+        data = cache.get(key)
+        if data is not None:
+            try:
+                document, messages = pickle.loads(data)
+            except Exception:  # pylint: disable=broad-except
+                document = None
+            if document is not None:
+                self.document = self.refurbish(document)
+                self.replay(messages)
+                return
+        self.messages = []
+        try:
+            standalone.Reader.parse(self)
+            self.document.reporter.detach_observer(self.messages.append)
+            cache.set(key, self.dump(self.document, self.messages))
+        finally:
+            self.messages = None
+
+    def new_document(self):
+        document = standalone.Reader.new_document(self)
+        if self.messages is not None:
+            document.reporter.attach_observer(self.messages.append)
+        return document
+
+    def replay(self, messages):
+        """Emit the messages recorded while parsing a cached doctree."""
+        for message in messages:
+            attributes = dict((name, message[name])
+                              for name in ('source', 'line') if name in message)
+            children = [child.deepcopy() for child in message.children[1:]]
+            text = message[0].astext() if len(message) else ''
+            self.document.reporter.system_message(
+                message['level'], text, *children, **attributes)
+
+    def refurbish(self, document):
+        """Attach a loaded doctree to the current settings."""
+        document.transformer = transforms.Transformer(document)
+        document.settings = self.settings
+        document.reporter = utils.new_reporter(document.get('source', ''),
+                                               self.settings)
+        return document
+
+    @staticmethod
+    def dump(document, messages):
+        """Serialize a doctree, without its run specific attributes, and the
+        messages emitted while parsing it."""
+        saved = document.settings, document.reporter, document.transformer
+        document.settings = document.reporter = document.transformer = None
+        try:
+            return pickle.dumps((document, messages), pickle.HIGHEST_PROTOCOL)
+        finally:
+            document.settings, document.reporter, document.transformer = saved
+
+
+class FastPreviewSpec(SettingsSpec):
+
+    """Documents the ``--fast`` option of ``cm2html`` in its help"""
+
+    settings_spec = (
+        'Fast Preview Options',
+        None,
+        (('Render an HTML fragment with the fast preview renderer instead of '
+          'docutils.  No other option is accepted with it.',
+          ['--fast'],
+          {'action': 'store_true'}),))
+
+
 def cm2html():
     description = ('Generate html document from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='html',
+    if '--fast' in sys.argv[1:]:
+        fast_preview(sys.argv[1:])
+        return
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='html',
                     parser=CommonMarkParser(),
+                    settings_spec=FastPreviewSpec(),
                     description=description)
 
 
+def fast_preview(args):
+    """Render an HTML preview fragment without going through docutils.
+
+    Usage: ``cm2html --fast [source [destination]]``, reading from stdin and
+    writing to stdout when the paths are omitted or ``-``. The docutils
+    options of ``cm2html`` do not apply to the preview, and are rejected.
+    """
+    from recommonmark.preview import render_preview
+
+    arg_parser = argparse.ArgumentParser(
+        prog='cm2html --fast',
+        description='Render an HTML preview fragment of a markdown source.')
+    arg_parser.add_argument('--fast', action='store_true',
+                            help=argparse.SUPPRESS)
+    arg_parser.add_argument('source', nargs='?', default='-',
+                            help='markdown source, stdin by default')
+    arg_parser.add_argument('destination', nargs='?', default='-',
+                            help='HTML output, stdout by default')
+    options = arg_parser.parse_args(args)
+    if options.source == '-':
+        text = sys.stdin.read()
+    else:
+        with io.open(options.source, encoding='utf-8') as fin:
+            text = fin.read()
+    html = render_preview(text)
+    if options.destination == '-':
+        sys.stdout.write(html)
+    else:
+        with io.open(options.destination, 'w', encoding='utf-8') as fout:
+            fout.write(html)
+
+
 def cm2man():
     description = ('Generate a manpage from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='manpage',
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='manpage',
                     parser=CommonMarkParser(),
                     description=description)
 
 
 def cm2xml():
     description = ('Generate XML document from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='xml',
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='xml',
                     parser=CommonMarkParser(),
                     description=description)
 
 
 def cm2pseudoxml():
     description = ('Generate pseudo-XML document from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='pseudoxml',
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='pseudoxml',
                     parser=CommonMarkParser(),
                     description=description)
 
 
 def cm2latex():
     description = ('Generate latex document from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='latex',
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='latex',
                     parser=CommonMarkParser(),
                     description=description)
 
 
 def cm2xetex():
     description = ('Generate xetex document from markdown sources. ' + default_description)
-    publish_cmdline(writer_name='latex',
+    publish_cmdline(reader=CachingReader(),
+                    writer_name='latex',
                     parser=CommonMarkParser(),
                     description=description)
@@ -1,9 +1,8 @@
 """Implement statemachine and state that are needed to Generate Derivatives."""
 
 from docutils.statemachine import StateMachineWS
-from docutils.parsers.rst import languages
+from docutils.parsers.rst import languages, roles
 from docutils.parsers.rst.states import Struct, RSTState, Inliner
-from docutils.parsers.rst.roles import role
 from docutils.parsers.rst.directives import directive
 
 
@@ -15,9 +14,14 @@ class DummyStateMachine(StateMachineWS):
     directive and roles. Usage:
     - Call `reset` to reset the state
     - Then call `run_directive` or `run_role` to generate the node.
+
+    ``role_functions`` is an optional dict caching the role functions of the
+    docutils registry looked up by `run_role`, which can be shared by several
+    state machines.
     """
 
-    def __init__(self):
+    def __init__(self, role_functions=None):
+        self.role_functions = {} if role_functions is None else role_functions
         self.memo = Struct(title_styles=[],
                            inliner=None)
         self.state = RSTState(self)
@@ -120,12 +124,11 @@ class DummyStateMachine(StateMachineWS):
             options = {}
         if content is None:
             content = []
-        role_fn, _ = role(name,
-                          self.language,
-                          self.node.line,
-                          self.reporter)
+        role_fn = self.lookup_role(name)
+        # Roles such as docutils' math role extract the text from rawtext,
+        # so it has to look like the interpreted text it stands for
         vec, _ = role_fn(name,
-                         rawtext=str(content),
+                         rawtext=':{0}:`{1}`'.format(name, content),
                          text=str(content),
                          lineno=self.node.line,
                          inliner=self.memo.inliner,
@@ -134,6 +137,31 @@ class DummyStateMachine(StateMachineWS):
         assert len(vec) == 1, 'only support one list in role'
         return vec[0]
 
+    def lookup_role(self, name):
+        """Return the role function called ``name``, or None.
+
+        Roles are looked up like in reStructuredText, so the roles defined
+        by the document and, in Sphinx, the roles of its default domain come
+        first. Only roles found in the docutils registry are cached in
+        ``role_functions``, and a cached role is used as long as the
+        document does not define another role of the same name.
+        """
+        key = (name, self.document.settings.language_code)
+        role_fn = self.role_functions.get(key)
+        if role_fn is not None and (
+                roles._roles.get(name.lower(), role_fn) is role_fn):
+            return role_fn
+        # roles.role is replaced by Sphinx while reading a document
+        role_fn, messages = roles.role(name,
+                                       self.language,
+                                       self.node.line,
+                                       self.reporter)
+        if role_fn is not None and not messages and any(
+                role_fn is registered
+                for registered in roles._role_registry.values()):
+            self.role_functions[key] = role_fn
+        return role_fn
+
     def get_source_and_line(self, lineno=None):
         if lineno:
             return (self.document['source'], lineno)
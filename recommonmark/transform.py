@@ -2,13 +2,19 @@
 
 import os
 import re
+import time
 
 from docutils import nodes, transforms
 from docutils.statemachine import StringList
-from docutils.parsers.rst import Parser
+from docutils.parsers.rst import Parser, languages, roles
+from docutils.parsers.rst.directives import directive
 from docutils.utils import new_document
 from sphinx import addnodes
+from sphinx.directives.other import TocTree
+from sphinx.util import docname_join, url_re
+from sphinx.util.matching import Matcher
 
+from .dependencies import get_toc_dependencies
 from .states import DummyStateMachine
 
 
@@ -20,8 +26,16 @@ class AutoStructify(transforms.Transform):
     """
 
     def __init__(self, *args, **kwargs):
+        # Keep construction cheap: this transform is registered globally, so
+        # it is instantiated for every document, including non-markdown ones.
+        # Configuration is only loaded in `apply` once the document is known
+        # to be markdown.
         transforms.Transform.__init__(self, *args, **kwargs)
         self.reporter = self.document.reporter
+        self.config = None
+
+    def load_config(self):
+        """Load the AutoStructify configuration of the current document."""
         self.config = self.default_config.copy()
         try:
             new_cfg = self.document.settings.env.config.recommonmark_config
@@ -35,9 +49,34 @@ class AutoStructify(transforms.Transform):
             self.reporter.warning(
                 'AutoStructify option "enable_auto_doc_ref" is deprecated')
 
+    def is_commonmark_document(self):
+        """Check whether the current document was written in markdown.
+
+        Documents parsed by `CommonMarkParser` are marked by the parser, so
+        other documents are skipped without looking at the configuration.
+        Marked documents must also match ``commonmark_suffixes``.
+        """
+        if not getattr(self.document, 'commonmark_parsed', False):
+            return False
+        source = self.document.get('source')
+        if not source:
+            return False
+        try:
+            new_cfg = self.document.settings.env.config.recommonmark_config
+        except AttributeError:
+            new_cfg = {}
+        suffixes = new_cfg.get('commonmark_suffixes',
+                               self.default_config['commonmark_suffixes'])
+        return source.endswith(tuple(suffixes))
+
     # set to a high priority so it can be applied first for markdown docs
     default_priority = 1
     suffix_set = set(['md', 'rst'])
+    # Maximum number of distinct inline formulas kept by the build cache
+    max_cached_roles = 10000
+    # Sphinx settings the nodes of cached inline formulas depend on
+    math_settings = ('html_math_renderer', 'math_number_all',
+                     'math_eqref_format', 'math_numfig')
 
     default_config = {
         'enable_auto_doc_ref': False,
@@ -50,6 +89,9 @@ class AutoStructify(transforms.Transform):
         'commonmark_suffixes': ['.md'],
         'url_resolver': lambda x: x,
         'known_url_schemes': None,
+        'max_node_count': None,
+        'max_nesting_depth': None,
+        'max_parse_time': None,
     }
 
     def parse_ref(self, ref):
@@ -176,17 +218,129 @@ class AutoStructify(transforms.Transform):
                 refs.append((title, docpath))
             else:
                 refs.append((title, uri))
+        self.note_toc_dependencies([target for _, target in refs])
+        options = {
+            'maxdepth': self.config['auto_toc_maxdepth'],
+            'numbered': numbered,
+        }
+        toc = self.build_toctree(node.parent, refs, options)
+        if toc is not None:
+            return toc
         self.state_machine.reset(self.document,
                                  node.parent,
                                  self.current_level)
         return self.state_machine.run_directive(
             'toctree',
-            options={
-                'maxdepth': self.config['auto_toc_maxdepth'],
-                'numbered': numbered,
-            },
+            options=options,
             content=['%s <%s>' % (k, v) for k, v in refs])
 
+    def build_toctree(self, parent, refs, options):
+        """Build the nodes of the toctree directive from resolved entries.
+
+        This gives the same nodes, warnings and environment updates as
+        running Sphinx's toctree directive on ``'title <target>'`` lines,
+        without formatting the entries and parsing them back.
+
+        Parameters
+        ----------
+        parent : docutils node
+            The node the toctree directive would have been run in.
+        refs : list of (str, str)
+            The titles and targets of the toctree entries.
+        options : dict
+            The ``maxdepth`` and ``numbered`` directive options.
+
+        Returns
+        -------
+        nodes : list of docutils node
+            The warnings and the toctree wrapper, or None if the directive
+            has to be run instead: when it is not Sphinx's, or for titles
+            which would not survive the round trip through the directive
+            syntax unchanged.
+        """
+        env = getattr(self.document.settings, 'env', None)
+        if env is None or not hasattr(env, 'found_docs'):
+            return None
+        language = languages.get_language(
+            self.document.settings.language_code)
+        if directive('toctree', language, self.document)[0] is not TocTree:
+            return None
+        for title, _ in refs:
+            if (not title or title != title.rstrip() or '<' in title or
+                    '\x00' in title):
+                return None
+
+        toctree = addnodes.toctree()
+        toctree['parent'] = env.docname
+        toctree['entries'] = []
+        toctree['includefiles'] = []
+        toctree['maxdepth'] = options['maxdepth']
+        toctree['caption'] = None
+        toctree['glob'] = False
+        toctree['hidden'] = False
+        toctree['includehidden'] = False
+        toctree['numbered'] = options['numbered']
+        toctree['titlesonly'] = False
+        toctree.source, toctree.line = self.document['source'], parent.line
+        wrapper = nodes.compound(classes=['toctree-wrapper'])
+        wrapper.append(toctree)
+
+        result = []
+        excluded = None
+        for title, ref in refs:
+            docname = ref
+            for suffix in env.config.source_suffix:
+                if docname.endswith(suffix):
+                    docname = docname[:-len(suffix)]
+                    break
+            docname = docname_join(env.docname, docname)
+            if url_re.match(ref) or ref == 'self':
+                toctree['entries'].append((title, ref))
+            elif docname not in env.found_docs:
+                if excluded is None:
+                    excluded = Matcher(env.config.exclude_patterns)
+                if excluded(env.doc2path(docname, None)):
+                    message = ('toctree contains reference to excluded '
+                               'document %r')
+                else:
+                    message = ('toctree contains reference to nonexisting '
+                               'document %r')
+                result.append(self.document.reporter.warning(
+                    message % docname, line=parent.line))
+                env.note_reread()
+            else:
+                toctree['entries'].append((title, docname))
+                toctree['includefiles'].append(docname)
+        result.append(wrapper)
+        return result
+
+    def note_toc_dependencies(self, targets):
+        """Record the documents a generated toctree refers to.
+
+        Each target is resolved to a docname the way the toctree directive
+        does, and stored with whether that document currently exists, so
+        that `recommonmark.dependencies` can have this document read again
+        when one of them is added or removed.
+
+        Parameters
+        ----------
+        targets : list of str
+            The targets of the toctree entries.
+        """
+        env = getattr(self.document.settings, 'env', None)
+        if env is None:
+            return
+        dependencies = get_toc_dependencies(env).setdefault(env.docname, {})
+        for target in targets:
+            if '://' in target:
+                continue
+            for suffix in env.config.source_suffix:
+                if target.endswith(suffix):
+                    target = target[:-len(suffix)]
+                    break
+            docname = docname_join(env.docname, target)
+            dependencies[docname] = docname in env.found_docs
+
     def auto_inline_code(self, node):
         """Try to automatically generate nodes for inline literals.
 
@@ -210,13 +364,37 @@ class AutoStructify(transforms.Transform):
             if not self.config['enable_inline_math']:
                 return None
             content = content[1:-1]
+            # The same formulas tend to be repeated across a build, and the
+            # math role only depends on its content and its context
+            cache = self.get_build_cache('math_roles')
+            key = (self.math_role_context(), content)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached.deepcopy()
             self.state_machine.reset(self.document,
                                      node.parent,
                                      self.current_level)
-            return self.state_machine.run_role('math', content=content)
+            result = self.state_machine.run_role('math', content=content)
+            if (len(cache) < self.max_cached_roles and
+                    isinstance(result, nodes.math)):
+                cache[key] = result.deepcopy()
+            return result
         else:
             return None
 
+    def math_role_context(self):
+        """Return what the math role depends on besides the formula.
+
+        That is the role function, which a document can replace, and the
+        math settings of Sphinx.
+        """
+        env = getattr(self.document.settings, 'env', None)
+        config = getattr(env, 'config', None)
+        role_fn = (roles._roles.get('math') or
+                   roles._role_registry.get('math'))
+        return (role_fn, self.document.settings.language_code) + tuple(
+            getattr(config, name, None) for name in self.math_settings)
+
     def auto_code_block(self, node):
         """Try to automatically generate nodes for codeblock syntax.
 
@@ -233,22 +411,27 @@ class AutoStructify(transforms.Transform):
         original_node = node
         if 'language' not in node:
             return None
-        self.state_machine.reset(self.document,
-                                 node.parent,
-                                 self.current_level)
-        content = node.rawsource.split('\n')
         language = node['language']
         if language == 'math':
             if self.config['enable_math']:
-                return self.state_machine.run_directive(
-                    'math', content=content)
+                return self.build_code_node('math', node) or (
+                    self.run_code_directive('math', node))
         elif language == 'eval_rst':
             if self.config['enable_eval_rst']:
+                self.state_machine.reset(self.document,
+                                         node.parent,
+                                         self.current_level)
+                content = node.rawsource.split('\n')
+                # The content starts on the line after the opening fence
+                offset = original_node.line or 0
                 # allow embed non section level rst
                 node = nodes.section()
                 self.state_machine.state.nested_parse(
-                    StringList(content, source=original_node.source),
-                    0, node=node, match_titles=True)
+                    StringList(content, items=[
+                        (original_node.source or self.document['source'],
+                         offset + i)
+                        for i in range(len(content))]),
+                    offset, node=node, match_titles=True)
                 return node.children[:]
         else:
             match = re.search('[ ]?[\w_-]+::.*', language)
@@ -257,13 +440,68 @@ class AutoStructify(transforms.Transform):
                 new_doc = new_document(None, self.document.settings)
                 newsource = u'.. ' + match.group(0) + '\n' + node.rawsource
                 parser.parse(newsource, new_doc)
+                # The directive line stands for the opening fence
+                offset = (node.line or 1) - 1
+                for child in new_doc.traverse(include_self=False):
+                    if getattr(child, 'line', None):
+                        child.line += offset
                 return new_doc.children[:]
             else:
-                return self.state_machine.run_directive(
-                    'code-block', arguments=[language],
-                    content=content)
+                return self.build_code_node('code-block', node) or (
+                    self.run_code_directive('code-block', node, [language]))
         return None
 
+    def run_code_directive(self, name, node, arguments=None):
+        """Run directive ``name`` on the content of code block ``node``."""
+        self.state_machine.reset(self.document,
+                                 node.parent,
+                                 self.current_level)
+        return self.state_machine.run_directive(
+            name, arguments=arguments, content=node.rawsource.split('\n'))
+
+    def build_code_node(self, name, node):
+        """Build the nodes of an option-less code-block or math directive.
+
+        This gives the same nodes as running Sphinx's directive ``name`` on
+        the content of code block ``node``, without the directive machinery.
+
+        Returns
+        -------
+        nodes : list of docutils node
+            The ``literal_block`` or ``math_block`` node, or None if the
+            directive has to be run instead: outside Sphinx, with Sphinx
+            versions before 1.8, when an extension replaced the directive, or
+            when equations are numbered automatically.
+        """
+        try:
+            # MathDirective only exists from Sphinx 1.8
+            from sphinx.directives.code import CodeBlock
+            from sphinx.directives.patches import MathDirective
+        except ImportError:
+            return None
+        env = getattr(self.document.settings, 'env', None)
+        if env is None or not hasattr(env, 'config'):
+            return None
+        language = languages.get_language(
+            self.document.settings.language_code)
+        directive_class = directive(name, language, self.document)[0]
+        code = node.rawsource
+        if name == 'math':
+            if (directive_class is not MathDirective or
+                    env.config.math_number_all):
+                return None
+            newnode = nodes.math_block(code, code, docname=env.docname,
+                                       number=None, label=None, nowrap=False)
+        else:
+            if directive_class is not CodeBlock:
+                return None
+            newnode = nodes.literal_block(code, code)
+            newnode['language'] = node['language']
+            newnode['linenos'] = False
+            newnode['highlight_args'] = {}
+        newnode.source, newnode.line = self.document['source'], node.parent.line
+        return [newnode]
+
     def find_replace(self, node):
         """Try to find replace node for current node.
 
@@ -290,43 +528,94 @@ class AutoStructify(transforms.Transform):
     def traverse(self, node):
         """Traverse the document tree rooted at node.
 
+        The traversal is iterative, so arbitrarily deep trees are supported.
+        It stops with an error message once more than ``max_node_count``
+        nodes have been visited, a node deeper than ``max_nesting_depth`` is
+        reached, or it took more than ``max_parse_time`` seconds.
+
         node : docutil node
             current root node to traverse
         """
         old_level = self.current_level
-        if isinstance(node, nodes.section):
-            if 'level' in node:
-                self.current_level = node['level']
-        to_visit = []
-        to_replace = []
-        for c in node.children[:]:
-            newnode = self.find_replace(c)
-            if newnode is not None:
-                to_replace.append((c, newnode))
-            else:
-                to_visit.append(c)
+        max_count = self.config.get('max_node_count')
+        max_depth = self.config.get('max_nesting_depth')
+        deadline = None
+        if self.config.get('max_parse_time') is not None:
+            deadline = time.time() + self.config['max_parse_time']
+        count = 0
+        stack = [(node, self.current_level, 0)]
+        while stack:
+            node, self.current_level, depth = stack.pop()
+            count += 1
+            if max_count is not None and count > max_count:
+                self.stop('max_node_count', max_count)
+                break
+            if max_depth is not None and depth > max_depth:
+                self.stop('max_nesting_depth', max_depth)
+                break
+            if deadline is not None and time.time() > deadline:
+                self.stop('max_parse_time', '{0}s'.format(
+                    self.config['max_parse_time']))
+                break
+            if isinstance(node, nodes.section):
+                if 'level' in node:
+                    self.current_level = node['level']
+            to_visit = []
+            children = []
+            replaced = False
+            for c in node.children[:]:
+                newnode = self.find_replace(c)
+                if newnode is None:
+                    to_visit.append(c)
+                    children.append(c)
+                    continue
+                replaced = True
+                if isinstance(newnode, nodes.Node):
+                    children.append(newnode)
+                else:
+                    children.extend(newnode)
+
+            # Replace all the children at once, replacing them one by one
+            # with node.replace is quadratic in the number of children.
+            if replaced:
+                node[:] = children
+
+            # Children are pushed in reverse to keep the depth-first order
+            for child in reversed(to_visit):
+                stack.append((child, self.current_level, depth + 1))
+        self.current_level = old_level
 
-        for oldnode, newnodes in to_replace:
-            node.replace(oldnode, newnodes)
+    def stop(self, limit, value):
+        """Add the error message of a traversal stopped by ``limit``."""
+        self.document.append(self.reporter.error(
+            'AutoStructify stopped: {0} exceeded ({1})'.format(limit, value)))
 
-        for child in to_visit:
-            self.traverse(child)
-        self.current_level = old_level
+    def get_build_cache(self, name):
+        """Return the cache dict ``name`` shared by the whole build.
+
+        The caches live on the Sphinx application, so they are dropped with
+        it. Without one they only last as long as this transform.
+        """
+        env = getattr(self.document.settings, 'env', None)
+        holder = getattr(env, 'app', None) or self
+        caches = holder.__dict__.setdefault('recommonmark_caches', {})
+        return caches.setdefault(name, {})
 
     def apply(self):
         """Apply the transformation by configuration."""
-        source = self.document['source']
-
-        self.reporter.info('AutoStructify: %s' % source)
-
         # only transform markdowns
-        if not source.endswith(tuple(self.config['commonmark_suffixes'])):
+        if not self.is_commonmark_document():
             return
 
+        source = self.document['source']
+        self.reporter.info('AutoStructify: %s' % source)
+        self.load_config()
+
         self.url_resolver = self.config['url_resolver']
         assert callable(self.url_resolver)
 
-        self.state_machine = DummyStateMachine()
+        self.state_machine = DummyStateMachine(
+            self.get_build_cache('role_functions'))
         self.current_level = 0
         self.file_dir = os.path.abspath(os.path.dirname(self.document['source']))
         self.root_dir = os.path.abspath(self.document.settings.env.srcdir)
@@ -0,0 +1,86 @@
+"""Do the first-use work of reading markdown before parallel readers fork.
+
+Parsing the first markdown document of a process costs several times more
+than the next ones: the markdown backend builds its parser, docutils loads
+its language modules, and the reStructuredText inliner used for embedded
+reStructuredText compiles its regular expressions. In parallel builds
+(``-j``) every forked reader used to pay that cost again. At
+``builder-inited``, this module parses a small sample document in the main
+process instead, so the readers inherit all of it.
+"""
+
+from docutils.frontend import OptionParser
+from docutils.parsers.rst import Parser as RSTParser
+from docutils.statemachine import StringList
+from docutils.utils import new_document
+from docutils import languages, nodes
+from sphinx.util import logging
+
+from .backends import get_backend
+
+__all__ = ['warm_up', 'setup']
+
+logger = logging.getLogger(__name__)
+
+SAMPLE = u'''# Title
+
+Text with *emphasis*, **strong**, `code`, [a link](http://example.com) and
+![an image](image.png).
+
+> - item
+>
+>   1. item
+
+```python
+code
+```
+
+---
+'''
+
+RST_SAMPLE = [
+    u'Text with *emphasis*, **strong**, ``literal``, :emphasis:`role` and',
+    u'`a link <http://example.com>`_.',
+]
+
+
+def warm_up(app):
+    """Parse sample documents with the settings of the build of ``app``."""
+    from .parser import CommonMarkParser
+    from .states import DummyStateMachine
+
+    config = getattr(app.config, 'recommonmark_config', None) or {}
+    backend_name = config.get('markdown_backend', 'commonmark')
+    get_backend(backend_name).parse(SAMPLE)
+
+    # Without an environment the parser keeps to its default configuration
+    # and does not touch the state of the build
+    defaults = dict(app.env.settings, env=None)
+    settings = OptionParser(components=(RSTParser,),
+                            defaults=defaults).get_default_values()
+    document = new_document('<recommonmark warm-up>', settings)
+    CommonMarkParser().parse(SAMPLE, document)
+    languages.get_language(settings.language_code, document.reporter)
+
+    # The role functions looked up here are shared with AutoStructify
+    caches = app.__dict__.setdefault('recommonmark_caches', {})
+    state_machine = DummyStateMachine(caches.setdefault('role_functions', {}))
+    section = nodes.section()
+    state_machine.reset(document, section, 0)
+    state_machine.state.nested_parse(
+        StringList(RST_SAMPLE, source=document['source']), 0, node=section)
+    state_machine.lookup_role('math')
+
+
+def builder_inited(app):
+    if app.parallel <= 1:
+        return
+    try:
+        warm_up(app)
+    except Exception:  # pylint: disable=broad-except
+        # Warming up is only an optimization, readers do the work otherwise
+        logger.debug('[recommonmark] warm-up failed', exc_info=True)
+
+
+def setup(app):
+    app.connect('builder-inited', builder_inited)
@@ -7,10 +7,27 @@ Author: Steve Genoud and Luca Barbato
 Date: 2014-10-17
 """
 
+import sys
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
 import recommonmark
 
 
+class BuildPy(build_py):
+
+    """Leave out the modules which need a newer Python than the current one"""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 6):
+            # recommonmark.aio uses async generators
+            modules = [module for module in modules
+                       if (module[0], module[1]) != ('recommonmark', 'aio')]
+        return modules
+
+
+
 setup(
     name='recommonmark',
     version=recommonmark.__version__,
@@ -35,5 +52,6 @@ setup(
         'cm2xetex = recommonmark.scripts:cm2xetex',
         'cm2xml = recommonmark.scripts:cm2xml',
     ]},
-    packages=['recommonmark']
+    packages=['recommonmark'],
+    cmdclass={'build_py': BuildPy},
 )
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+extensions = ['recommonmark']
+source_suffix = ['.rst', '.md']
+master_doc = 'index'
+project = u'sphinxproj'
+copyright = u'2015, rtfd'
+author = u'rtfd'
+version = '0.1'
+release = '0.1'
+highlight_language = 'python'
+language = None
+exclude_patterns = ['_build']
+pygments_style = 'sphinx'
+html_theme = 'alabaster'
+htmlhelp_basename = 'sphinxproj'
+
+
+def setup(app):
+    app.add_config_value('recommonmark_config', {
+        'heading_index': True,
+    }, True)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+from recommonmark.transform import AutoStructify
+
+extensions = ['recommonmark']
+source_suffix = ['.rst', '.md']
+master_doc = 'index'
+project = u'sphinxproj'
+copyright = u'2015, rtfd'
+author = u'rtfd'
+version = '0.1'
+release = '0.1'
+language = None
+exclude_patterns = ['_build']
+html_theme = 'alabaster'
+
+
+def setup(app):
+    app.add_config_value('recommonmark_config', {}, True)
+    app.add_transform(AutoStructify)
@@ -1,14 +1,12 @@
 
 # -*- coding: utf-8 -*-
 
-from recommonmark.parser import CommonMarkParser
 
-extensions = 'sphinx.ext.autosectionlabel']
+extensions = ['recommonmark', 'sphinx.ext.autosectionlabel']
 autosectionlabel_prefix_document = True
 
 templates_path = ['_templates']
 source_suffix = '.md'
-source_parsers = { '.md': CommonMarkParser }
 master_doc = 'index'
 project = u'sphinxproj'
 copyright = u'2015, rtfd'
@@ -23,3 +21,9 @@ todo_include_todos = False
 html_theme = 'alabaster'
 html_static_path = ['_static']
 htmlhelp_basename = 'sphinxproj'
+
+
+def setup(app):
+    app.add_config_value('recommonmark_config', {
+        'known_url_schemes': ['http', 'https', 'mailto'],
+    }, True)
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import unittest
+
+from recommonmark import aio
+
+# Module functions since Python 3.7
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+current_task = (getattr(asyncio, 'current_task', None) or
+                asyncio.Task.current_task)
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def collect(results):
+    return [result async for result in results]
+
+
+class RenderManyTests(unittest.TestCase):
+
+    settings = {'output_encoding': 'unicode'}
+
+    def test_matches_sync_render(self):
+        jobs = [('# Title {0}\n\nBody *{0}*'.format(i), 'html', self.settings)
+                for i in range(20)]
+        jobs.append(aio.RenderJob('Foo', 'pseudoxml', self.settings))
+        results = run(collect(aio.render_many(jobs, max_workers=3)))
+        self.assertEqual(sorted(r.index for r in results),
+                         list(range(len(jobs))))
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.output, aio.render(*jobs[result.index]))
+
+    def test_async_jobs(self):
+        async def jobs():
+            for i in range(5):
+                yield ('Text {0}'.format(i), 'pseudoxml', self.settings)
+
+        results = run(collect(aio.render_many(jobs())))
+        self.assertEqual(
+            sorted(r.output.splitlines()[-1].strip() for r in results),
+            ['Text {0}'.format(i) for i in range(5)])
+
+    def test_errors_and_timeouts(self):
+        original = aio.render
+
+        def render(source, *args):
+            if source == 'slow':
+                time.sleep(0.5)
+            return original(source, *args)
+
+        aio.render = render
+        try:
+            jobs = [('slow',), ('Foo', 'no-such-writer'), ('Foo',)]
+            results = run(collect(aio.render_many(jobs, timeout=0.1)))
+        finally:
+            aio.render = original
+        errors = dict((r.index, r.error) for r in results)
+        self.assertIsInstance(errors[0], asyncio.TimeoutError)
+        self.assertIsInstance(errors[1], ImportError)
+        self.assertIsNone(errors[2])
+
+    def test_backpressure(self):
+        pulled = []
+
+        def jobs():
+            for i in range(10):
+                pulled.append(i)
+                yield ('Foo {0}'.format(i),)
+
+        async def first():
+            results = aio.render_many(jobs(), max_workers=1, max_pending=2)
+            result = await results.__anext__()
+            await results.aclose()
+            return result
+
+        run(first())
+        self.assertLessEqual(len(pulled), 3)
+
+    def test_close_waits_for_cancelled_jobs(self):
+        jobs = [('Foo {0}'.format(i),) for i in range(10)]
+
+        async def first():
+            results = aio.render_many(jobs, max_workers=1)
+            await results.__anext__()
+            await results.aclose()
+            current = current_task()
+            return [task for task in all_tasks()
+                    if task is not current and not task.done()]
+
+        self.assertEqual(run(first()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,21 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import gc
+import io
+import threading
+import time
 import unittest
+import weakref
+import warnings
 from textwrap import dedent
 
 from docutils import nodes
 from docutils.utils import new_document
 from docutils.readers import Reader
 from docutils.core import publish_parts
+from docutils.frontend import OptionParser
+from docutils.parsers.rst import Parser as RstParser, roles
 
 from commonmark import Parser
-from recommonmark.parser import CommonMarkParser
+from commonmark.node import Node
+try:
+    import markdown_it
+except ImportError:
+    markdown_it = None
+
+from recommonmark.backends import CommonMarkBackend, MarkdownItBackend
+from recommonmark.parser import CommonMarkParser, ResourceLimitExceeded
+from recommonmark.states import DummyStateMachine
+from recommonmark.transform import AutoStructify
 
 
 class TestParsing(unittest.TestCase):
 
+    parser_class = CommonMarkParser
+
     def assertParses(self, source, expected, alt=False):  # noqa
-        parser = CommonMarkParser()
+        parser = self.parser_class()
         parser.parse(dedent(source), new_document('<string>'))
         self.maxDiff = None
         self.assertMultiLineEqual(
@@ -518,6 +537,557 @@ class TestParsing(unittest.TestCase):
             """
         )
 
+    def test_release_ast(self):
+        source = dedent(
+            """
+            # Heading
+
+            Text with a [link](http://example.com) and ![alt text](a.png)
+
+            - item
+            """
+        )
+
+        def convert(ast, release):
+            parser = CommonMarkParser()
+            parser.document = parser.current_node = new_document('<string>')
+            parser.config = parser.default_config.copy()
+            parser.setup_sections()
+            parser.convert_ast(ast, release=release)
+            return parser.document.pformat()
+
+        expected = convert(Parser().parse(source), release=False)
+        ast = Parser().parse(source)
+        self.assertEqual(expected, convert(ast, release=True))
+        self.assertIsNone(ast.first_child)
+
+
+class TestParseFragment(unittest.TestCase):
+
+    def test_same_as_parse(self):
+        sources = [
+            'Text with *emphasis* and a [link](http://example.com)',
+            '- item\n- ![alt text](a.png)',
+            '> quote\n\n```python\ncode\n```',
+        ]
+        parser = CommonMarkParser()
+        document = new_document('<string>')
+        for source in sources:
+            expected = new_document('<string>')
+            CommonMarkParser().parse(source, expected)
+            container = nodes.container()
+            document.append(container)
+            parser.parse_fragment(source, container)
+            self.assertEqual(
+                [child.pformat() for child in expected.children],
+                [child.pformat() for child in container.children])
+        self.assertFalse(hasattr(document, 'commonmark_parsed'))
+
+    def test_sections_and_records(self):
+        parser = CommonMarkParser()
+        document = new_document('<string>')
+        parser.parse('# Title', document)
+        container = nodes.container()
+        document.append(container)
+        parser.parse_fragment(
+            '# Heading\n\n[link](http://example.com)\n\n## Sub', container)
+        self.assertEqual(
+            [section[0].astext() for section in container.children],
+            ['Heading'])
+        self.assertEqual(container[0][2][0].astext(), 'Sub')
+        self.assertEqual(
+            [heading[:2] for heading in document.commonmark_headings],
+            [(1, 'Title'), (1, 'Heading'), (2, 'Sub')])
+
+    def test_detached_node(self):
+        parser = CommonMarkParser()
+        container = nodes.container()
+        self.assertRaises(ValueError, parser.parse_fragment, 'plain *text*',
+                          container)
+        parser.parse_fragment('plain *text*', container,
+                              new_document('<string>'))
+        self.assertEqual(container.astext(), 'plain text')
+
+    def test_fragment_document_released(self):
+        parser = CommonMarkParser()
+        document = new_document('<string>')
+        container = nodes.container()
+        document.append(container)
+        parser.parse_fragment('*text*', container)
+        ref = weakref.ref(document)
+        del document, container
+        gc.collect()
+        self.assertIsNone(ref())
+        # A new document starts a new set of fragments
+        document = new_document('<string>')
+        container = nodes.container()
+        document.append(container)
+        parser.parse_fragment('more', container)
+        self.assertEqual(container.astext(), 'more')
+
+
+class TestHandlers(unittest.TestCase):
+
+    def test_instance_override(self):
+        parser = CommonMarkParser()
+        document = new_document('<string>')
+        parser.parse('*a*', document)
+        self.assertEqual(len(document.traverse(nodes.emphasis)), 1)
+
+        def visit_emph(mdnode):
+            parser.current_node.append(nodes.strong())
+            parser.current_node = parser.current_node[-1]
+
+        parser.visit_emph = visit_emph
+        document = new_document('<string>')
+        parser.parse('*a*', document)
+        self.assertEqual(document.traverse(nodes.emphasis), [])
+        self.assertEqual(document[0][0].astext(), 'a')
+        self.assertEqual(document[0][0].tagname, 'strong')
+
+    def test_class_patched_later(self):
+        class Parser(CommonMarkParser):
+            pass
+
+        document = new_document('<string>')
+        Parser().parse('text', document)
+        Parser.visit_text = lambda self, mdnode: self.current_node.append(
+            nodes.Text(mdnode.literal.upper()))
+        document = new_document('<string>')
+        Parser().parse('text', document)
+        self.assertEqual(document.astext(), 'TEXT')
+
+
+class LimitedParser(CommonMarkParser):
+
+    default_config = dict(CommonMarkParser.default_config,
+                          max_input_size=10000,
+                          max_nesting_depth=50,
+                          max_node_count=100)
+
+
+class TestResourceLimits(unittest.TestCase):
+
+    def parse(self, source):
+        document = new_document('<string>')
+        LimitedParser().parse(source, document)
+        return document
+
+    def assertLimitError(self, document, limit):  # noqa
+        messages = document.traverse(nodes.system_message)
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]['level'], 3)
+        self.assertIn(limit, messages[0].astext())
+
+    def test_within_limits(self):
+        document = self.parse('> > quote\n\n- item')
+        self.assertEqual(document.traverse(nodes.system_message), [])
+
+    def test_input_size(self):
+        document = self.parse('a' * 10001)
+        self.assertLimitError(document, 'max_input_size')
+        self.assertEqual(len(document.children), 1)
+
+    def test_nesting_depth(self):
+        document = self.parse('>' * 3000 + ' deep')
+        self.assertLimitError(document, 'max_nesting_depth')
+
+    def test_nesting_depth_before_tokenizing(self):
+        class RecordingBackend(object):
+            texts = []
+
+            def parse(self, text):
+                self.texts.append(text)
+                return Parser().parse(text)
+
+        class RecordingParser(LimitedParser):
+            default_config = dict(LimitedParser.default_config,
+                                  markdown_backend=RecordingBackend())
+
+        for source in ['>' * 3000 + ' deep', '- ' * 60 + 'deep',
+                       '> 1. ' * 30 + 'deep']:
+            document = new_document('<string>')
+            RecordingParser().parse(source, document)
+            self.assertLimitError(document, 'max_nesting_depth')
+        self.assertEqual(RecordingBackend.texts, [])
+        RecordingParser().parse('> - 1. > quote', new_document('<string>'))
+        self.assertEqual(len(RecordingBackend.texts), 1)
+
+    def test_node_count(self):
+        document = self.parse('*a* ' * 200)
+        self.assertLimitError(document, 'max_node_count')
+
+    def test_parse_time(self):
+        class SlowParser(CommonMarkParser):
+            default_config = dict(CommonMarkParser.default_config,
+                                  max_parse_time=0)
+
+        document = new_document('<string>')
+        SlowParser().parse('Foo', document)
+        self.assertLimitError(document, 'max_parse_time')
+        self.assertIn('while tokenizing', document[0].astext())
+
+    def test_tokenizer_deadline(self):
+        backend = CommonMarkBackend()
+        self.assertRaises(ResourceLimitExceeded, backend.parse,
+                          'Foo\n', deadline=time.time() - 1)
+        self.assertEqual(backend.parse('*Foo*\n', deadline=time.time() + 60)
+                         .first_child.first_child.t, 'emph')
+
+    def test_transform_limits(self):
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        for limit, value in [('max_nesting_depth', 5), ('max_parse_time', -1),
+                             ('max_node_count', 5)]:
+            document = new_document('<string>', settings)
+            CommonMarkParser().parse('> ' * 10 + '`code`', document)
+            transform = AutoStructify(document)
+            transform.config = dict(transform.default_config,
+                                    **{limit: value})
+            transform.current_level = 0
+            transform.state_machine = DummyStateMachine()
+            transform.traverse(document)
+            self.assertLimitError(document, 'AutoStructify stopped: ' + limit)
+
+
+class CustomBlockBackend(object):
+
+    """Backend producing containers which the parser does not handle"""
+
+    def parse(self, text):
+        document = Node('document', [[1, 1], [0, 0]])
+        for i in range(int(text)):
+            document.append_child(Node('custom_block', [[i + 1, 1], [0, 0]]))
+        return document
+
+
+class TestWarnings(unittest.TestCase):
+
+    def parse(self, count, **config):
+        class CustomBlockParser(CommonMarkParser):
+            default_config = dict(CommonMarkParser.default_config,
+                                  markdown_backend=CustomBlockBackend(),
+                                  **config)
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            CustomBlockParser().parse(str(count), new_document('<string>'))
+        return [str(warning.message) for warning in caught]
+
+    def test_no_warnings(self):
+        self.assertEqual(self.parse(0), [])
+
+    def test_examples_and_summary(self):
+        messages = self.parse(25, warning_examples=3)
+        self.assertEqual(messages[:3],
+                         ['Container node skipped: type=custom_block'] * 3)
+        self.assertEqual(len(messages), 4)
+        self.assertIn('22 more container warnings', messages[3])
+        self.assertIn('<string> (25)', messages[3])
+
+    def test_all_warnings(self):
+        self.assertEqual(len(self.parse(25, warning_examples=None)), 25)
+
+    def test_sphinx_builds(self):
+        class Env(object):
+            docname = 'index'
+
+        class CustomBlockParser(CommonMarkParser):
+            default_config = dict(CommonMarkParser.default_config,
+                                  markdown_backend=CustomBlockBackend(),
+                                  warning_examples=3)
+
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        settings.env = Env()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            CustomBlockParser().parse('5', new_document('<string>', settings))
+        # Warnings of the parser are not Sphinx warnings unless asked for
+        self.assertEqual(len(caught), 4)
+
+    def test_fragments(self):
+        class CustomBlockParser(CommonMarkParser):
+            default_config = dict(CommonMarkParser.default_config,
+                                  markdown_backend=CustomBlockBackend(),
+                                  warning_examples=3)
+
+        parser = CustomBlockParser()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for document in [new_document('<a>'), new_document('<b>')]:
+                for _ in range(5):
+                    parser.parse_fragment('5', nodes.container(), document)
+            parser.finish_fragments()
+        messages = [str(warning.message) for warning in caught]
+        self.assertEqual(len(messages), 8)
+        self.assertIn('22 more container warnings', messages[3])
+        self.assertIn('<a> (25)', messages[3])
+        self.assertIn('<b> (25)', messages[7])
+
+
+class MarkdownItParser(CommonMarkParser):
+
+    default_config = dict(CommonMarkParser.default_config,
+                          markdown_backend='markdown-it')
+
+
+@unittest.skipIf(markdown_it is None, 'markdown-it-py is not installed')
+class TestParsingMarkdownIt(TestParsing):
+
+    parser_class = MarkdownItParser
+
+    def test_unmapped_tokens(self):
+        backend = MarkdownItBackend()
+        backend._md.enable(['strikethrough', 'table'])
+
+        class ExtendedParser(CommonMarkParser):
+            default_config = dict(CommonMarkParser.default_config,
+                                  markdown_backend=backend)
+
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        settings.warning_stream = io.StringIO()
+        document = new_document('<string>', settings)
+        ExtendedParser().parse('a ~~b~~ c\n\n| x |\n|---|\n| y |\n',
+                               document)
+        paragraph, table = document.children
+        self.assertEqual(paragraph.astext(), 'a b c')
+        self.assertEqual(paragraph[1].tagname, 'inline')
+        self.assertEqual(paragraph[1]['classes'], ['s'])
+        self.assertEqual(table.tagname, 'container')
+        self.assertEqual(table['classes'], ['table'])
+        self.assertEqual(table.astext(), 'x\n\ny')
+        warnings = settings.warning_stream.getvalue()
+        self.assertIn('<string>:1: (WARNING/2) Unsupported markdown token '
+                      '"s"', warnings)
+        self.assertIn('"td"', warnings)
+
+
+class TestThreadSafety(unittest.TestCase):
+
+    def test_concurrent_parse(self):
+        sources = [
+            dedent(
+                """
+                # Document {0}
+
+                Some *text* with a [link](doc{0}.md).
+
+                ## Section {0}
+
+                - item {0}
+                - item
+
+                > quote
+
+                ```python
+                print({0})
+                ```
+                """
+            ).format(i)
+            for i in range(40)
+        ]
+
+        def parse(parser, source):
+            document = new_document('<string>')
+            parser.parse(source, document)
+            return document.pformat()
+
+        expected = [parse(CommonMarkParser(), source) for source in sources]
+
+        parser = CommonMarkParser()
+        results = {}
+
+        def worker(indexes):
+            for _ in range(5):
+                for i in indexes:
+                    results.setdefault(i, set()).add(parse(parser, sources[i]))
+
+        threads = [threading.Thread(target=worker, args=(range(n, 40, 8),))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i, source in enumerate(sources):
+            self.assertEqual(results[i], set([expected[i]]))
+
+
+class TestDummyStateMachine(unittest.TestCase):
+
+    def test_role_rawtext(self):
+        calls = []
+
+        def capture_role(name, rawtext, text, lineno, inliner, options=None,
+                         content=None):
+            calls.append((rawtext, text))
+            return [nodes.literal(rawtext, text)], []
+
+        roles.register_local_role('capture', capture_role)
+        try:
+            settings = OptionParser(
+                components=(RstParser,)).get_default_values()
+            document = new_document('<string>', settings)
+            paragraph = nodes.paragraph()
+            document.append(paragraph)
+            state_machine = DummyStateMachine()
+            state_machine.reset(document, paragraph, 0)
+            state_machine.run_role('capture', content='x^2')
+            # Roles get the text in the form of interpreted text
+            self.assertEqual(calls, [(':capture:`x^2`', 'x^2')])
+            self.assertEqual(
+                state_machine.run_role('math', content='x^2').astext(), 'x^2')
+        finally:
+            del roles._roles['capture']
+
+    def test_role_cache(self):
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        role_functions = {}
+
+        def lookup(name):
+            document = new_document('<string>', settings)
+            paragraph = nodes.paragraph()
+            document.append(paragraph)
+            state_machine = DummyStateMachine(role_functions)
+            state_machine.reset(document, paragraph, 0)
+            return state_machine.lookup_role(name)
+
+        def local_role(name, rawtext, text, lineno, inliner, options=None,
+                       content=None):
+            return [nodes.literal(rawtext, text)], []
+
+        emphasis = lookup('emphasis')
+        self.assertIs(role_functions[('emphasis', 'en')], emphasis)
+        saved = roles._roles['emphasis']
+        try:
+            # Roles defined by a document are neither cached nor shadowed
+            roles.register_local_role('emphasis', local_role)
+            roles.register_local_role('local', local_role)
+            self.assertIs(lookup('emphasis'), local_role)
+            self.assertIs(lookup('local'), local_role)
+            self.assertNotIn(('local', 'en'), role_functions)
+        finally:
+            roles._roles['emphasis'] = saved
+            del roles._roles['local']
+        self.assertIs(lookup('emphasis'), emphasis)
+
+
+class TestAutoStructify(unittest.TestCase):
+
+    def test_marks_markdown_documents(self):
+        document = new_document('<string>')
+        CommonMarkParser().parse('Body', document)
+        self.assertTrue(document.commonmark_parsed)
+
+    def test_deep_traverse(self):
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        document = new_document('<string>', settings)
+        source = ''.join('>' * 3000 + line for line in ['```math\n', 'x\n'])
+        CommonMarkParser().parse(source, document)
+        transform = AutoStructify(document)
+        transform.config = transform.default_config.copy()
+        transform.current_level = 0
+        transform.state_machine = DummyStateMachine()
+        transform.traverse(document)
+        # docutils' own traverse is recursive, walk down by hand
+        node = document
+        while isinstance(node, nodes.block_quote) or node is document:
+            node = node[0]
+        self.assertIsInstance(node, nodes.math_block)
+
+    def test_traverse_replaces_in_order(self):
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        document = new_document('<string>', settings)
+        CommonMarkParser().parse(
+            'a `$x$` b `$y$` c\n\n```eval_rst\none\n\ntwo\n```\n\nafter',
+            document)
+        transform = AutoStructify(document)
+        transform.config = transform.default_config.copy()
+        transform.current_level = 0
+        transform.state_machine = DummyStateMachine()
+        transform.traverse(document)
+        paragraph = document[0]
+        self.assertEqual([type(node).__name__ for node in paragraph],
+                         ['Text', 'math', 'Text', 'math', 'Text'])
+        self.assertEqual([node.astext() for node in paragraph],
+                         ['a ', 'x', ' b ', 'y', ' c'])
+        self.assertTrue(all(node.parent is paragraph for node in paragraph))
+        # A block replaced by several nodes keeps its place
+        self.assertEqual([node.astext() for node in document],
+                         ['a x b y c', 'one', 'two', 'after'])
+        self.assertTrue(all(node.parent is document for node in document))
+
+    def test_inline_math_cache(self):
+        class App(object):
+            pass
+
+        class Env(object):
+            app = App()
+            config = None
+            srcdir = '.'
+
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        settings.env = Env()
+        documents = []
+        for source in ['`$x^2$` and `$y$`', '`$x^2$` and `$x^2$`']:
+            document = new_document('page.md', settings)
+            CommonMarkParser().parse(source, document)
+            AutoStructify(document).apply()
+            documents.append(document)
+        first, second = [document.traverse(nodes.math)
+                         for document in documents]
+        self.assertEqual(
+            [node.astext() for node in first + second],
+            ['x^2', 'y', 'x^2', 'x^2'])
+        # Cached nodes are copied, never shared between places
+        self.assertEqual(len(set(map(id, first + second))), 4)
+        self.assertIs(second[0].parent, second[1].parent)
+        self.assertEqual(
+            sorted(content for _, content in
+                   Env.app.recommonmark_caches['math_roles']),
+            ['x^2', 'y'])
+
+        # A math role defined by a document is not served from the cache
+        def literal_role(name, rawtext, text, lineno, inliner, options=None,
+                         content=None):
+            return [nodes.literal(rawtext, text)], []
+
+        saved = roles._roles.get('math')
+        roles.register_local_role('math', literal_role)
+        try:
+            document = new_document('page.md', settings)
+            CommonMarkParser().parse('`$x^2$`', document)
+            AutoStructify(document).apply()
+            self.assertEqual(document.traverse(nodes.math), [])
+            self.assertEqual(document[0][0].astext(), 'x^2')
+        finally:
+            if saved is None:
+                del roles._roles['math']
+            else:
+                roles._roles['math'] = saved
+
+    def test_skips_non_markdown_documents(self):
+        document = new_document('index.rst')
+        transform = AutoStructify(document)
+        transform.apply()
+        # Configuration is never loaded for documents that are not markdown
+        self.assertIsNone(transform.config)
+
+    def test_checks_suffixes_of_markdown_documents(self):
+        class Config(object):
+            recommonmark_config = {'commonmark_suffixes': ['.markdown']}
+
+        class Env(object):
+            config = Config()
+
+        settings = OptionParser(components=(RstParser,)).get_default_values()
+        settings.env = Env()
+        document = new_document('page.md', settings)
+        CommonMarkParser().parse('```math\nx\n```', document)
+        transform = AutoStructify(document)
+        transform.apply()
+        self.assertIsNone(transform.config)
+        self.assertEqual(document.traverse(nodes.math_block), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,158 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from docutils.core import publish_string
+
+from recommonmark import cache as cache_module
+from recommonmark.cache import DiskCache, make_key, user_key
+from recommonmark.parser import CommonMarkParser
+from recommonmark.scripts import CachingReader
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.home = tempfile.mkdtemp()
+        self.key_file = cache_module.KEY_FILE
+        cache_module.KEY_FILE = os.path.join(self.home, 'key', 'secret')
+
+    def tearDown(self):
+        cache_module.KEY_FILE = self.key_file
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.home)
+
+
+class DiskCacheTests(CacheTestCase):
+
+    def test_roundtrip(self):
+        cache = DiskCache(os.path.join(self.directory, 'sub'))
+        key = make_key(u'source', 1, None)
+        self.assertIsNone(cache.get(key))
+        cache.set(key, b'data')
+        self.assertEqual(cache.get(key), b'data')
+        self.assertNotEqual(make_key(u'source', 2, None), key)
+
+    def test_corrupt_entry(self):
+        cache = DiskCache(self.directory)
+        cache.set('key', b'data')
+        path = os.path.join(self.directory, 'key' + DiskCache.suffix)
+        with open(path, 'r+b') as fout:
+            fout.seek(-1, os.SEEK_END)
+            fout.write(b'\0')
+        self.assertIsNone(cache.get('key'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_forged_entry(self):
+        directory = os.path.join(self.directory, 'entries')
+        DiskCache(directory, key=b'other user').set('key', b'data')
+        cache = DiskCache(directory)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', b'data')
+        self.assertEqual(cache.get('key'), b'data')
+        self.assertEqual(DiskCache(directory).get('key'), b'data')
+
+    def test_user_key(self):
+        key = user_key()
+        self.assertEqual(len(key), 32)
+        self.assertEqual(user_key(), key)
+        path = cache_module.KEY_FILE
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), key)
+        if os.name == 'posix':
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.assertEqual(
+                os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+
+    def test_eviction(self):
+        cache = DiskCache(self.directory)
+        for i in range(5):
+            cache.set(str(i), os.urandom(1000))
+            os.utime(os.path.join(self.directory, str(i) + cache.suffix),
+                     (i, i))
+        cache.max_size = 2500
+        # Reading an entry makes it the most recently used one
+        cache.get('0')
+        cache.set('5', os.urandom(1000))
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['0' + cache.suffix, '5' + cache.suffix])
+
+    def test_shared_directory(self):
+        # Two writers, like parallel Sphinx processes
+        caches = [DiskCache(self.directory, 8000),
+                  DiskCache(self.directory, 8000)]
+        for i in range(20):
+            caches[i % 2].set(str(i), os.urandom(500))
+            total = sum(os.path.getsize(os.path.join(self.directory, name))
+                        for name in os.listdir(self.directory))
+            self.assertLessEqual(total, 8000 + 2 * 1100)
+
+
+class CountingParser(CommonMarkParser):
+
+    parses = 0
+
+    def parse(self, inputstring, document):
+        CountingParser.parses += 1
+        CommonMarkParser.parse(self, inputstring, document)
+
+
+class ShallowParser(CountingParser):
+
+    default_config = dict(CountingParser.default_config, max_nesting_depth=3)
+
+
+class CachingReaderTests(CacheTestCase):
+
+    def setUp(self):
+        CacheTestCase.setUp(self)
+        CountingParser.parses = 0
+
+    def publish(self, source, writer_name, parser_class=CountingParser,
+                **settings):
+        settings.setdefault('doctree_cache', self.directory)
+        settings['output_encoding'] = 'unicode'
+        return publish_string(source, source_path='doc.md',
+                              reader=CachingReader(), parser=parser_class(),
+                              writer_name=writer_name,
+                              settings_overrides=settings)
+
+    def test_cache_hit(self):
+        source = '# Title\n\nSome *text* and a [link](http://example.com).'
+        expected = self.publish(source, 'html', doctree_cache=None)
+        self.assertEqual(CountingParser.parses, 1)
+        self.assertEqual(self.publish(source, 'html'), expected)
+        self.assertEqual(CountingParser.parses, 2)
+        # Writer settings and writers can change without parsing again
+        self.assertEqual(self.publish(source, 'html'), expected)
+        self.assertIn('<title>Title</title>',
+                      self.publish(source, 'xml', doctitle_xform=False))
+        self.assertEqual(CountingParser.parses, 2)
+        self.publish(source + ' More', 'html')
+        self.assertEqual(CountingParser.parses, 3)
+
+    def test_parser_settings(self):
+        source = '# Title\n\n## Section'
+        self.assertIn('ids="section"', self.publish(source, 'pseudoxml'))
+        self.assertIn('ids="p-section"',
+                      self.publish(source, 'pseudoxml', id_prefix='p-'))
+        self.assertEqual(CountingParser.parses, 2)
+
+    def test_messages_replayed(self):
+        source = '> > > > > quote'
+        for _ in range(2):
+            stream = io.StringIO()
+            output = self.publish(source, 'pseudoxml', ShallowParser,
+                                  warning_stream=stream)
+            self.assertIn('not fully converted', stream.getvalue())
+            self.assertEqual(stream.getvalue().count('(ERROR/3)'), 1)
+            self.assertEqual(output.count('<system_message'), 1)
+        self.assertEqual(CountingParser.parses, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
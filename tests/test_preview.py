@@ -0,0 +1,112 @@
+"""Compare the fast HTML preview with the docutils pipeline.
+
+The preview is expected to differ from ``cm2html`` in the following ways,
+which the tests below pin down:
+
+* headings are not wrapped in sections, they carry the section id instead
+* the output is an HTML fragment, not a full page
+* cross-references are plain links instead of being resolved
+* no transform runs, so AutoStructify features such as inline math are not
+  rendered
+"""
+
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from textwrap import dedent
+
+from docutils import nodes
+from docutils.core import publish_parts
+from docutils.utils import new_document
+
+from recommonmark.parser import CommonMarkParser
+from recommonmark.preview import render_preview
+from recommonmark.scripts import fast_preview
+
+
+SOURCE = dedent(
+    """
+    # Heading *one*
+
+    Text with [a doc](other.md), [an anchor](#heading-one),
+    [a site](https://example.com/page.md) and [a mail](mailto:me@example.com).
+
+    ![alt text](image.png)
+
+    - item `code`
+
+    `$x^2$`
+    """
+)
+
+
+class PreviewTests(unittest.TestCase):
+
+    def test_links_match_parser(self):
+        for schemes in (None, ['https']):
+            document = new_document('<string>')
+            parser = CommonMarkParser()
+            parser.default_config = dict(parser.default_config,
+                                         known_url_schemes=schemes)
+            parser.parse(SOURCE, document)
+            expected = [ref['refuri']
+                        for ref in document.traverse(nodes.reference)]
+            html = render_preview(SOURCE, known_url_schemes=schemes)
+            self.assertEqual(re.findall(r'href="([^"]*)"', html), expected)
+
+    def test_heading_ids_match_sections(self):
+        document = new_document('<string>')
+        CommonMarkParser().parse(SOURCE, document)
+        html = render_preview(SOURCE)
+        self.assertIn('<h1 id="{0}">'.format(document[0]['ids'][0]), html)
+
+    def test_differences(self):
+        html = render_preview(SOURCE)
+        self.assertNotIn('<html', html)
+        self.assertNotIn('class="section"', html)
+        self.assertIn('<code>$x^2$</code>', html)
+        self.assertIn('<img src="image.png" alt="alt text" />', html)
+
+    def test_same_text(self):
+        source = 'Some *emphasis*, **strong** and `code`.\n\n> quote'
+        full = publish_parts(source, parser=CommonMarkParser(),
+                             writer_name='html')['body']
+        strip = lambda html: re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', '', html))
+        self.assertEqual(strip(full).strip(),
+                         strip(render_preview(source)).strip())
+
+
+class FastPreviewScriptTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'a.md')
+        self.destination = os.path.join(self.directory, 'a.html')
+        with io.open(self.source, 'w', encoding='utf-8') as fout:
+            fout.write(SOURCE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_paths(self):
+        fast_preview(['--fast', self.source, self.destination])
+        with io.open(self.destination, encoding='utf-8') as fin:
+            self.assertEqual(fin.read(), render_preview(SOURCE))
+
+    def test_rejects_docutils_options(self):
+        with open(os.devnull, 'w') as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                self.assertRaises(SystemExit, fast_preview,
+                                  ['--fast', '--stylesheet', 's.css',
+                                   self.source])
+            finally:
+                sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    unittest.main()
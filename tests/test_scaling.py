@@ -0,0 +1,184 @@
+"""Check that parsing and transforming scale linearly with the input size.
+
+For every markdown construct, documents of growing size are generated and
+run through `CommonMarkParser.parse` and `AutoStructify.apply`. The work is
+measured by counting the Python lines executed, which does not depend on the
+load of the machine, and the growth exponent fitted on the counts must stay
+below `MAX_EXPONENT`. This catches quadratic loops written in Python, such
+as relinking nodes one by one.
+
+Quadratic work hidden in C calls, such as the ``list.index`` of replacing
+children one by one, only shows in timings. Setting the
+``RECOMMONMARK_SCALING_TIME`` environment variable fits the exponent on CPU
+time instead, with `MAX_TIME_EXPONENT`. Timings are noisy on shared
+machines, so this is not done by default.
+"""
+
+import gc
+import math
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from docutils.frontend import OptionParser
+from docutils.parsers.rst import Parser as RstParser
+from docutils.utils import new_document
+
+from recommonmark.parser import CommonMarkParser
+from recommonmark.transform import AutoStructify
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+MAX_EXPONENT = 1.05
+MAX_TIME_EXPONENT = 1.15
+SCALES = (1, 4, 16)
+REPEAT = 3
+TIMED = bool(os.environ.get('RECOMMONMARK_SCALING_TIME'))
+
+
+class Config(object):
+    recommonmark_config = {}
+
+
+class Env(object):
+    srcdir = tempfile.gettempdir()
+    config = Config()
+
+
+def headings(n):
+    return ''.join('{0} Heading {1}\n\nText\n\n'.format('#' * (i % 6 + 1), i)
+                   for i in range(n))
+
+
+def nested_lists(n):
+    return ''.join('- item {0}\n  - sub\n    - subsub\n'.format(i)
+                   for i in range(n))
+
+
+def links(n):
+    # commonmark itself is quadratic in the length of a paragraph, so links
+    # are spread over paragraphs.
+    return ''.join('[doc {0}](doc{0}.md) [site](http://example.com/{0})\n\n'
+                   .format(i) for i in range(n))
+
+
+def images(n):
+    return ''.join('![screen &amp; shot {0}](img{0}.png)\n\n'.format(i)
+                   for i in range(n))
+
+
+def block_quotes(n):
+    return ''.join('> quote {0}\n> > nested\n\n'.format(i) for i in range(n))
+
+
+def code_blocks(n):
+    return ''.join('```\ncode {0}\n```\n\n```math\nx_{0}\n```\n\n'.format(i)
+                   for i in range(n))
+
+
+def inline_math(n):
+    return ' '.join('`$x_{{{0}}}$`'.format(i) for i in range(n))
+
+
+def html_blocks(n):
+    return ''.join('<div>\nblock {0}\n</div>\n\n'.format(i) for i in range(n))
+
+
+class ScalingTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = OptionParser(
+            components=(RstParser,)).get_default_values()
+        cls.settings.env = Env()
+        cls.settings.report_level = 5
+
+    def convert(self, source):
+        document = new_document('page.md', self.settings)
+        CommonMarkParser().parse(source, document)
+        AutoStructify(document).apply()
+
+    def count_lines(self, source):
+        """Return the number of Python lines executed to convert ``source``."""
+        counter = [0]
+
+        def trace(frame, event, arg):
+            if event == 'line':
+                counter[0] += 1
+            return trace
+
+        previous = sys.gettrace()
+        sys.settrace(trace)
+        try:
+            self.convert(source)
+        finally:
+            sys.settrace(previous)
+        return counter[0]
+
+    def time_source(self, source):
+        best = None
+        for _ in range(REPEAT):
+            gc.collect()
+            gc.disable()
+            try:
+                start = process_time()
+                self.convert(source)
+                elapsed = process_time() - start
+            finally:
+                gc.enable()
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def assertLinear(self, generate, base):  # noqa
+        measure = self.time_source if TIMED else self.count_lines
+        max_exponent = MAX_TIME_EXPONENT if TIMED else MAX_EXPONENT
+        # Warm up the caches filled by the first conversion
+        self.convert(generate(base))
+        points = []
+        for scale in SCALES:
+            source = generate(base * scale)
+            points.append((math.log(len(source)),
+                           math.log(measure(source))))
+        # Least squares slope of log(work) against log(size)
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        exponent = (
+            sum((x - mean_x) * (y - mean_y) for x, y in points) /
+            sum((x - mean_x) ** 2 for x, _ in points))
+        self.assertLess(exponent, max_exponent,
+                        '{0} scales with exponent {1:.2f}'.format(
+                            generate.__name__, exponent))
+
+    def test_headings(self):
+        self.assertLinear(headings, 100)
+
+    def test_nested_lists(self):
+        self.assertLinear(nested_lists, 40)
+
+    def test_links(self):
+        self.assertLinear(links, 60)
+
+    def test_images(self):
+        self.assertLinear(images, 100)
+
+    def test_block_quotes(self):
+        self.assertLinear(block_quotes, 100)
+
+    def test_code_blocks(self):
+        self.assertLinear(code_blocks, 100)
+
+    def test_inline_math(self):
+        self.assertLinear(inline_math, 500)
+
+    def test_html_blocks(self):
+        self.assertLinear(html_blocks, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
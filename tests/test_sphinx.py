@@ -1,11 +1,22 @@
 import os
 import io
+import json
+import logging
 import sys
 import shutil
+import tempfile
 import unittest
 from contextlib import contextmanager
 
+from docutils import nodes
+
+from sphinx import addnodes
 from sphinx.application import Sphinx
+from sphinx.transforms.post_transforms import ReferencesResolver
+
+from recommonmark.highlighting import HIGHLIGHT_LOGGER
+from recommonmark.references import MarkdownReferences, get_resolution_cache
+from recommonmark.transform import AutoStructify
 
 
 @contextmanager
@@ -226,3 +237,940 @@ class CustomExtensionTests(SphinxIntegrationTests):
              '</ul>\n</li>\n</ul>'),
             output
             )
+
+
+class XrefTests(SphinxIntegrationTests):
+
+    build_path = 'tests/sphinx_xref'
+
+    def test_links(self):
+        output = self.read_file('index.html')
+        self.assertIn(
+            '<a class="reference internal" href="link.html">'
+            '<span class="doc">absolute link</span></a>', output)
+        self.assertIn(
+            '<a class="reference internal" href="link.html#section-1">'
+            '<span class="std std-ref">ref with spaces</span></a>', output)
+
+    def test_roles(self):
+        doctree = self.app.env.get_doctree('index')
+        self.assertEqual(
+            [node['reftype'] for node in
+             doctree.traverse(addnodes.pending_xref)],
+            ['any', 'any', 'any'])
+        self.app.env.temp_data['docname'] = 'index'
+        MarkdownReferences(doctree).apply()
+        self.assertEqual(doctree.traverse(addnodes.pending_xref), [])
+        self.assertEqual(
+            [node['refuri'] for node in doctree.traverse(nodes.reference)
+             if node.get('internal')],
+            ['link.html', 'link.html', 'link.html#section-1'])
+        cache = get_resolution_cache(self.app)
+        self.assertEqual(cache.outcomes[('', 'ref', 'link:section 1')],
+                         ('ref', 'link', 'section-1'))
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+
+    def test_same_as_any(self):
+        self.app.env.temp_data['docname'] = 'index'
+        expected = self.app.env.get_doctree('index')
+        ReferencesResolver(expected).apply()
+        doctree = self.app.env.get_doctree('index')
+        MarkdownReferences(doctree).apply()
+        ReferencesResolver(doctree).apply()
+        self.assertEqual(doctree.pformat(), expected.pformat())
+        self.assertIn('classes="doc doc doc"', doctree.pformat())
+
+
+class ResolutionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        self.write('conf.py', u'extensions = ["recommonmark"]\n'
+                              u'master_doc = "index"\n')
+        self.write('index.md', u'# Index\n\n' + u'[New](new)\n\n' * 5)
+        self.make_app()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self):
+        self.warning = io.StringIO()
+        self.app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, 'html'),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername='html',
+            status=None,
+            warning=self.warning,
+        )
+
+    def write(self, name, text):
+        with io.open(os.path.join(self.srcdir, name), 'w') as fout:
+            fout.write(text)
+
+    def read_html(self, name):
+        with io.open(os.path.join(self.tmpdir, 'html', name),
+                     encoding='utf-8') as fin:
+            return fin.read()
+
+    def test_incremental_build(self):
+        self.app.build()
+        cache = get_resolution_cache(self.app)
+        self.assertEqual(cache.outcomes, {('', 'any', 'new'): None})
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+        # Unresolved references served from the cache are still reported
+        self.assertEqual(self.warning.getvalue().count(
+            'any reference target not found: new'), 5)
+        self.assertNotIn('href="new.html"', self.read_html('index.html'))
+        self.write('new.md', u'# New\n')
+        self.write('index.md', u'# Index\n\n' + u'[New](new)\n\n' * 5)
+        self.app.build()
+        self.assertEqual(cache.outcomes, {('', 'doc', 'new'): ('doc', 'new')})
+        self.assertEqual(
+            self.read_html('index.html').count('href="new.html"'), 5)
+
+    def test_added_document(self):
+        self.app.build()
+        # Documents which are not read again see the new document too
+        self.write('new.md', u'# New\n')
+        self.app.build(force_all=True)
+        self.assertEqual(get_resolution_cache(self.app).outcomes,
+                         {('', 'doc', 'new'): ('doc', 'new')})
+        self.assertEqual(
+            self.read_html('index.html').count('href="new.html"'), 5)
+
+    def test_ambiguous_target(self):
+        self.write('new.md', u'# New\n')
+        self.write('other.rst', u':orphan:\n\n.. _new:\n\nOther\n=====\n')
+        self.app.build()
+        self.assertEqual(self.warning.getvalue().count(
+            "more than one target found for 'any' cross-reference 'new'"), 5)
+        self.assertEqual(
+            self.read_html('index.html').count('href="new.html"'), 5)
+
+    def test_other_references(self):
+        self.write('conf.py', u'extensions = ["recommonmark"]\n'
+                              u'master_doc = "index"\n'
+                              u'from recommonmark.transform import '
+                              u'AutoStructify\n'
+                              u'def setup(app):\n'
+                              u'    app.add_transform(AutoStructify)\n')
+        self.write('index.md', u'# Index\n\n[New](new)\n\n[New](new)\n\n'
+                               u'```eval_rst\n'
+                               u'See [CIT2002]_ and :c:func:`missing`.\n\n'
+                               u'.. [CIT2002] A citation.\n'
+                               u'```\n')
+        self.make_app()
+        calls = []
+
+        def missing_reference(app, env, node, contnode):
+            if node['reftarget'] == 'new':
+                calls.append(node)
+                return nodes.reference('', '', contnode, refuri='new.html')
+
+        self.app.connect('missing-reference', missing_reference)
+        self.app.build()
+        # Each handler is called once for each reference
+        self.assertEqual(len(calls), 2)
+        html = self.read_html('index.html')
+        self.assertEqual(html.count('href="new.html"'), 2)
+        self.assertIn('href="#cit2002"', html)
+
+
+class HeadingIndexTests(SphinxIntegrationTests):
+
+    build_path = 'tests/sphinx_extension'
+
+    def test_heading_index(self):
+        index = json.loads(self.read_file('recommonmark_headings.json'))
+        self.assertEqual(index['index'], [
+            {'level': 1, 'title': 'Index', 'anchor': 'index', 'line': 1},
+            {'level': 2, 'title': 'Getting started',
+             'anchor': 'getting-started', 'line': 5},
+            {'level': 3, 'title': 'Details', 'anchor': 'details', 'line': 9},
+        ])
+        self.assertEqual(index['other'][1]['anchor'], 'getting-started')
+        self.assertNotIn('plain', index)
+        self.assertEqual(self.app.env.recommonmark_headings['other'][0],
+                         (1, 'Other page', 'other-page', 1))
+        # The records are moved out of the stored doctree
+        doctree = self.app.env.get_doctree('index')
+        self.assertTrue(doctree.commonmark_parsed)
+        self.assertFalse(hasattr(doctree, 'commonmark_headings'))
+
+
+class TocDependencyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        shutil.copytree('tests/sphinx_toctree', self.srcdir)
+        self.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self):
+        """Build incrementally and return the docnames which were read."""
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, 'html'),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername='html',
+            status=None,
+            warning=io.StringIO(),
+        )
+        read = set()
+        app.connect('env-before-read-docs',
+                    lambda app, env, docnames: read.update(docnames))
+        app.build()
+        return read
+
+    def write(self, name, text):
+        with io.open(os.path.join(self.srcdir, name), 'w') as fout:
+            fout.write(text)
+
+    def read_html(self, name):
+        with io.open(os.path.join(self.tmpdir, 'html', name),
+                     encoding='utf-8') as fin:
+            return fin.read()
+
+    def test_add(self):
+        os.rename(os.path.join(self.srcdir, 'b.md'),
+                  os.path.join(self.tmpdir, 'b.md'))
+        self.build()
+        self.assertNotIn('Page B', self.read_html('index.html'))
+        os.rename(os.path.join(self.tmpdir, 'b.md'),
+                  os.path.join(self.srcdir, 'b.md'))
+        self.assertEqual(self.build(), set(['index', 'b']))
+        self.assertIn('Page B', self.read_html('index.html'))
+
+    def test_delete(self):
+        os.remove(os.path.join(self.srcdir, 'b.md'))
+        self.assertEqual(self.build(), set(['index']))
+        self.assertNotIn('Page B', self.read_html('index.html'))
+
+    def test_rename(self):
+        os.rename(os.path.join(self.srcdir, 'sub.md'),
+                  os.path.join(self.srcdir, 'sub2.md'))
+        self.assertEqual(self.build(), set(['other', 'sub2']))
+
+
+PARALLEL_CONF = u'''
+from recommonmark.transform import AutoStructify
+
+extensions = ['recommonmark']
+source_suffix = ['.rst', '.md']
+master_doc = 'index'
+project = u'sphinxproj'
+exclude_patterns = ['_build']
+html_theme = 'alabaster'
+
+
+def source_read(app, docname, source):
+    if docname == 'page7':
+        source[0] = source[0].replace('# Page 7', '# Page seven')
+
+
+def setup(app):
+    app.connect('source-read', source_read)
+    app.add_config_value('recommonmark_config', {
+        'heading_index': True,
+        'preparse_workers': PREPARSE_WORKERS,
+        'schedule_parallel_reads': True,
+    }, True)
+    app.add_transform(AutoStructify)
+'''
+
+
+class ParallelBuildTests(unittest.TestCase):
+
+    documents = 200
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        self.write_conf()
+        self.write('index.md', u'# Index\n\n' + u''.join(
+            u'* [Page {0}](page{0}.md)\n'.format(i)
+            for i in range(self.documents)))
+        for i in range(self.documents):
+            self.write('page{0}.md'.format(i), (
+                u'# Page {0}\n\n'
+                u'Link to [the next page](page{1}.md) and `$x_{0}$`.\n\n'
+                u'## Section {0}\n\n'
+                u'```python\nprint({0})\n```\n\n'
+                u'```eval_rst\n.. note:: Note {0}\n```\n'
+            ).format(i, (i + 1) % self.documents))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        with io.open(os.path.join(self.srcdir, name), 'w') as fout:
+            fout.write(text)
+
+    def write_conf(self, preparse_workers=None):
+        self.write('conf.py', u'PREPARSE_WORKERS = {0!r}\n{1}'.format(
+            preparse_workers, PARALLEL_CONF))
+
+    def build(self, parallel, name=None):
+        name = name or str(parallel)
+        outdir = os.path.join(self.tmpdir, 'html' + name)
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=outdir,
+            doctreedir=os.path.join(self.tmpdir, 'doctrees' + name),
+            buildername='html',
+            status=None,
+            warning=io.StringIO(),
+            parallel=parallel,
+        )
+        app.build(force_all=True)
+        self.assertEqual(app.statuscode, 0)
+        output = {}
+        for name in os.listdir(outdir):
+            if name.endswith(('.html', '.json')):
+                with io.open(os.path.join(outdir, name),
+                             encoding='utf-8') as fin:
+                    output[name] = fin.read()
+        return app, output
+
+    def test_parallel_matches_serial(self):
+        serial_app, serial = self.build(1)
+        parallel_app, parallel = self.build(4)
+        self.assertEqual(len(serial), self.documents + 4)
+        self.assertEqual(sorted(serial), sorted(parallel))
+        for name in serial:
+            self.assertEqual(serial[name], parallel[name], name)
+        for attr in ('recommonmark_headings',
+                     'recommonmark_toc_dependencies'):
+            self.assertEqual(getattr(serial_app.env, attr),
+                             getattr(parallel_app.env, attr))
+        self.assertEqual(sorted(serial_app.env.recommonmark_read_times),
+                         sorted(parallel_app.env.recommonmark_read_times))
+
+    def test_preparse_matches_serial(self):
+        serial_app, serial = self.build(1)
+        self.assertIn('Page seven', serial['page7.html'])
+        self.write_conf(preparse_workers=2)
+        preparse_app, preparsed = self.build(1, 'preparse')
+        hits, misses = preparse_app.recommonmark_preparse_stats
+        self.assertEqual(hits + misses, self.documents + 1)
+        self.assertGreater(hits, 0)
+        # page7 is changed by a source-read handler and parsed in line
+        self.assertGreater(misses, 0)
+        self.assertIsNone(preparse_app.recommonmark_preparser)
+        self.assertEqual(sorted(serial), sorted(preparsed))
+        for name in serial:
+            self.assertEqual(serial[name], preparsed[name], name)
+
+
+class SchedulingTests(unittest.TestCase):
+
+    def test_schedule(self):
+        from sphinx.util.parallel import make_chunks
+        from recommonmark.scheduling import schedule
+
+        docnames = ['doc{0:03d}'.format(i) for i in range(100)]
+        costs = dict((docname, 1.0) for docname in docnames)
+        for docname in ('doc010', 'doc011', 'doc012'):
+            costs[docname] = 100.0
+        ordered = schedule(docnames, costs, 4)
+        self.assertEqual(sorted(ordered), docnames)
+        chunks = make_chunks(ordered, 4)
+        # Each expensive document leads one of the first chunks
+        self.assertEqual([chunk[0] for chunk in chunks[:3]],
+                         ['doc010', 'doc011', 'doc012'])
+        loads = [sum(costs[docname] for docname in chunk)
+                 for chunk in chunks]
+        self.assertEqual(loads, sorted(loads, reverse=True))
+        self.assertLessEqual(loads[3], loads[2])
+
+    def test_opt_in(self):
+        from recommonmark.scheduling import env_before_read_docs
+
+        class Config(object):
+            recommonmark_config = {}
+
+        class App(object):
+            config = Config()
+            parallel = 4
+
+        class Env(object):
+            recommonmark_read_times = dict(
+                ('doc{0}'.format(i), float(i)) for i in range(10))
+
+            def doc2path(self, docname):
+                return docname
+
+        docnames = ['doc{0}'.format(i) for i in range(10)]
+        ordered = list(docnames)
+        env_before_read_docs(App(), Env(), ordered)
+        self.assertEqual(ordered, docnames)
+        Config.recommonmark_config = {'schedule_parallel_reads': True}
+        env_before_read_docs(App(), Env(), ordered)
+        self.assertEqual(sorted(ordered), docnames)
+        self.assertEqual(ordered[0], 'doc9')
+
+
+class WarningAggregationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        self.write('index.md', u'# Index\n\n' + u''.join(
+            u'[missing {0}](missing{0}.md)\n\n'.format(i) for i in range(40)))
+        self.write('plain.rst', u'Plain\n=====\n\n' + u''.join(
+            u':doc:`missing{0}`\n\n'.format(i) for i in range(20)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, text):
+        with io.open(os.path.join(self.srcdir, name), 'w') as fout:
+            fout.write(text)
+
+    def build(self, **config):
+        self.write('conf.py', (
+            u'extensions = ["recommonmark"]\n'
+            u'source_suffix = [".rst", ".md"]\n'
+            u'master_doc = "index"\n'
+            u'def setup(app):\n'
+            u'    app.add_config_value("recommonmark_config", {0!r}, True)\n'
+        ).format(config))
+        warning = io.StringIO()
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, 'html'),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername='html',
+            status=None,
+            warning=warning,
+            freshenv=True,
+        )
+        app.build(force_all=True)
+        return warning.getvalue()
+
+    def test_examples_and_summary(self):
+        output = self.build(warning_examples=5, warning_log=True)
+        lines = [line for line in output.splitlines()
+                 if 'index.md' in line]
+        self.assertEqual(len(lines), 6)
+        self.assertIn('35 more ref.any warnings were not shown', lines[-1])
+        self.assertIn('40 in total in 1 location,', lines[-1])
+        # Warnings of other documents are left alone
+        self.assertEqual(output.count('unknown document'), 20)
+        path = os.path.join(self.tmpdir, 'html', 'recommonmark_warnings.log')
+        with io.open(path, encoding='utf-8') as fin:
+            self.assertEqual(len(fin.read().splitlines()), 40)
+
+    def test_all_warnings(self):
+        output = self.build(warning_examples=None)
+        self.assertEqual(output.count('index.md'), 40)
+
+    def test_not_aggregated_by_default(self):
+        output = self.build()
+        self.assertEqual(output.count('index.md'), 40)
+        self.assertNotIn('were not shown', output)
+
+
+class DirectToctreeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        shutil.copytree('tests/sphinx_toctree', self.srcdir)
+        with io.open(os.path.join(self.srcdir, 'index.md'), 'w') as fout:
+            fout.write(
+                u'# Index\n\n'
+                u'* [Page A](a.md)\n'
+                u'* [Page B](./b.md)\n'
+                u'* [Missing](missing.md)\n'
+                u'* [Example](http://example.com)\n\n'
+                u'## Others\n\n'
+                u'1. [Other <page>](other.md)\n'
+                u'2. [Sub](sub.md)\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, name):
+        warning = io.StringIO()
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, name),
+            doctreedir=os.path.join(self.tmpdir, name, '.doctrees'),
+            buildername='html',
+            status=None,
+            warning=warning,
+        )
+        app.build()
+        doctree = app.env.get_doctree('index')
+        toctrees = [
+            (node.source, node.line, sorted(node.attributes.items()))
+            for node in doctree.traverse(addnodes.toctree)]
+        warnings = [line for line in warning.getvalue().splitlines()
+                    if 'toctree' in line]
+        return (toctrees, doctree.pformat(), app.env.toctree_includes,
+                app.env.reread_always, warnings)
+
+    def test_same_as_directive(self):
+        direct = self.build('direct')
+        original = AutoStructify.build_toctree
+        AutoStructify.build_toctree = lambda self, *args: None
+        try:
+            directive = self.build('directive')
+        finally:
+            AutoStructify.build_toctree = original
+        self.assertEqual(direct, directive)
+        toctrees, _, _, reread, warnings = direct
+        self.assertEqual(dict(toctrees[0][2])['entries'], [
+            ('Page A', 'a'), ('Page B', 'b'),
+            ('Example', 'http://example.com')])
+        self.assertEqual(reread, set(['index']))
+        self.assertEqual(len(warnings), 1)
+        self.assertIn("nonexisting document 'missing'", warnings[0])
+
+
+class DirectCodeNodeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        shutil.copy('tests/sphinx_toctree/conf.py', self.srcdir)
+        with io.open(os.path.join(self.srcdir, 'index.md'), 'w') as fout:
+            fout.write(
+                u'# Index\n\n'
+                u'```python\nprint(1)\n\n  indented\n```\n\n'
+                u'> ```math\n> x^2\n> ```\n\n'
+                u'- ```c++\n  int x;\n  ```\n\n'
+                u'```math\n```\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, name):
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, name),
+            doctreedir=os.path.join(self.tmpdir, name, '.doctrees'),
+            buildername='html',
+            status=None,
+            warning=io.StringIO(),
+        )
+        app.build()
+        doctree = app.env.get_doctree('index')
+        blocks = doctree.traverse(
+            lambda node: isinstance(node, (nodes.literal_block,
+                                           nodes.math_block)))
+        with io.open(os.path.join(self.tmpdir, name, 'index.html'),
+                     encoding='utf-8') as fin:
+            html = fin.read()
+        return ([(node.source, node.line) for node in blocks],
+                doctree.pformat(), html)
+
+    def test_same_as_directive(self):
+        direct = self.build('direct')
+        original = AutoStructify.build_code_node
+        AutoStructify.build_code_node = lambda self, *args: None
+        try:
+            directive = self.build('directive')
+        finally:
+            AutoStructify.build_code_node = original
+        self.assertEqual(direct, directive)
+        self.assertEqual(len(direct[0]), 4)
+
+
+HIGHLIGHT_CONF = u'''
+extensions = ['recommonmark']
+source_suffix = ['.rst', '.md']
+master_doc = 'index'
+project = u'sphinxproj'
+exclude_patterns = ['_build']
+html_theme = 'alabaster'
+
+
+def setup(app):
+    app.add_config_value('recommonmark_config', {
+        'highlight_cache': HIGHLIGHT_CACHE,
+    }, True)
+'''
+
+
+class HighlightCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from recommonmark import cache
+        self.tmpdir = tempfile.mkdtemp()
+        self.key_file = cache.KEY_FILE
+        cache.KEY_FILE = os.path.join(self.tmpdir, 'key')
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        with io.open(os.path.join(self.srcdir, 'index.md'), 'w') as fout:
+            fout.write(
+                u'# Index\n\n'
+                u'```python\ndef f(x):\n    return x * 2\n```\n\n'
+                u'```c\nint main() { return 0; }\n```\n\n'
+                u'```json\n{"broken": @@ }\n```\n')
+        with io.open(os.path.join(self.srcdir, 'other.rst'), 'w') as fout:
+            fout.write(u':orphan:\n\nOther\n=====\n\n.. code-block:: python\n\n'
+                       u'   print(1)\n')
+
+    def tearDown(self):
+        from recommonmark import cache
+        cache.KEY_FILE = self.key_file
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self, name, cached):
+        with io.open(os.path.join(self.srcdir, 'conf.py'), 'w') as fout:
+            fout.write(HIGHLIGHT_CONF.replace('HIGHLIGHT_CACHE',
+                                              repr(cached)))
+        return Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, name),
+            doctreedir=os.path.join(self.tmpdir, name, '.doctrees'),
+            buildername='html',
+            status=None,
+            warning=io.StringIO(),
+            freshenv=True,
+        )
+
+    def html(self, name):
+        with io.open(os.path.join(self.tmpdir, name, 'index.html'),
+                     encoding='utf-8') as fin:
+            return fin.read()
+
+    def test_cache(self):
+        plain = self.make_app('plain', False)
+        plain.build()
+        self.assertFalse(hasattr(plain, 'recommonmark_highlight_stats'))
+
+        first = self.make_app('cached', True)
+        first.build()
+        self.assertEqual(first.recommonmark_highlight_stats,
+                         {'hits': 0, 'misses': 3})
+        self.assertTrue(os.path.isdir(os.path.join(
+            self.tmpdir, 'cached', '.doctrees', 'recommonmark_highlight')))
+        self.assertIn('Could not lex', first._warning.getvalue())
+        # The translator class is replaced through the registry, and the
+        # warning detection does not outlive the highlighting
+        self.assertNotIn('create_translator', vars(first.builder))
+        self.assertTrue(
+            first.builder.get_translator_class().__name__.startswith(
+                'Caching'))
+        self.assertEqual(logging.getLogger(HIGHLIGHT_LOGGER).filters, [])
+
+        second = self.make_app('cached', True)
+        second.build()
+        # The block which could not be lexed is not cached, and the code
+        # block of the reStructuredText document is left alone
+        self.assertEqual(second.recommonmark_highlight_stats,
+                         {'hits': 2, 'misses': 1})
+        self.assertIn('Could not lex', second._warning.getvalue())
+        self.assertEqual(self.html('plain'), self.html('cached'))
+
+
+LINKCHECK_CONF = u'''
+extensions = ['recommonmark']
+source_suffix = ['.rst', '.md']
+master_doc = 'index'
+project = u'sphinxproj'
+exclude_patterns = ['_build']
+linkcheck_workers = 2
+
+def setup(app):
+    app.add_config_value('recommonmark_config', {
+        'linkcheck_cache_ttl': 3600,
+    }, True)
+    app.add_transform(AutoStructify)
+
+from recommonmark.transform import AutoStructify
+'''
+
+
+class LinkCheckTests(unittest.TestCase):
+
+    def setUp(self):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import threading
+
+        requests = self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def respond(self):
+                requests.append(self.path)
+                self.send_response(200 if self.path.startswith('/ok') else 404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_GET = do_HEAD = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        base = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.srcdir)
+        with io.open(os.path.join(self.srcdir, 'conf.py'), 'w') as fout:
+            fout.write(LINKCHECK_CONF)
+        with io.open(os.path.join(self.srcdir, 'index.md'), 'w') as fout:
+            fout.write(
+                u'# Index\n\n'
+                u'[fine]({0}/ok) and [again]({0}/ok)\n\n'
+                u'[broken]({0}/missing)\n\n'
+                u'<{0}/ok2>\n\n'
+                u'[section](other.md#other)\n\n'
+                u'```eval_rst\n'
+                u'`embedded <{0}/missing-rst>`_\n\n'
+                u'.. toctree::\n\n   other\n'
+                u'```\n\n'
+                u'[broken again]({0}/missing)\n'.format(base))
+        with io.open(os.path.join(self.srcdir, 'other.rst'), 'w') as fout:
+            fout.write(u'Other\n=====\n\n`fine <{0}/ok>`_ and '
+                       u'`broken <{0}/missing>`_\n'.format(base))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, buildername, outdir):
+        del self.requests[:]
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, outdir),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername=buildername,
+            status=None,
+            warning=io.StringIO(),
+        )
+        app.build()
+        with io.open(os.path.join(self.tmpdir, outdir, 'output.txt'),
+                     encoding='utf-8') as fin:
+            return app, sorted(fin.read().splitlines())
+
+    def test_link_index(self):
+        app, _ = self.build('mdlinkcheck', 'mdlinkcheck')
+        base = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.assertEqual(app.env.recommonmark_links['index'], [
+            (base + '/ok', [3, 3]),
+            (base + '/missing', [5, 19]),
+            (base + '/ok2', [7]),
+            ('other.md#other', [9]),
+            (base + '/missing-rst', [12]),
+        ])
+        self.assertNotIn('other', app.env.recommonmark_links)
+
+    def test_link_index_after_transforms(self):
+        base = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        with io.open(os.path.join(self.srcdir, 'conf.py'), 'a') as fout:
+            fout.write(u"recommonmark_config = {'auto_toc_tree_section': "
+                       u"'Contents'}\n")
+        with io.open(os.path.join(self.srcdir, 'toc.md'), 'w') as fout:
+            fout.write(u'# Toc\n\n## Contents\n\n'
+                       u'* [Other](other.rst)\n* [Remote]({0}/ok2)\n\n'
+                       u'[fine]({0}/ok)\n'.format(base))
+        app, _ = self.build('mdlinkcheck', 'mdlinkcheck')
+        # The list became a toctree, its entries are not links of the page
+        self.assertEqual(app.env.recommonmark_links['toc'],
+                         [(base + '/ok', [8])])
+
+    def test_same_as_linkcheck(self):
+        _, expected = self.build('linkcheck', 'linkcheck')
+        self.assertEqual(len([line for line in expected
+                              if '[broken]' in line]), 4)
+
+        _, output = self.build('mdlinkcheck', 'mdlinkcheck')
+        self.assertEqual(output, expected)
+        # Every URL is checked once, broken ones are requested again after
+        # the failed HEAD request
+        self.assertEqual(sorted(self.requests), [
+            '/missing', '/missing', '/missing-rst', '/missing-rst',
+            '/ok', '/ok2',
+        ])
+
+        # Working URLs are remembered, broken ones are checked again
+        app, output = self.build('mdlinkcheck', 'mdlinkcheck')
+        self.assertEqual(output, expected)
+        self.assertEqual(sorted(self.requests), [
+            '/missing', '/missing', '/missing-rst', '/missing-rst',
+        ])
+        self.assertEqual((app.builder.checked, app.builder.cached), (3, 2))
+
+
+def gif(width, height):
+    import struct
+    return (b'GIF89a' + struct.pack('<HH', width, height) +
+            b'\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x00;')
+
+
+class ImageManifestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.tmpdir, 'src')
+        os.makedirs(os.path.join(self.srcdir, 'img'))
+        with io.open(os.path.join(self.srcdir, 'conf.py'), 'w') as fout:
+            fout.write(HIGHLIGHT_CONF.replace(
+                "'highlight_cache': HIGHLIGHT_CACHE",
+                "'image_manifest': True"))
+        for name, data in [('shot.gif', gif(3, 2)), ('copy.gif', gif(3, 2)),
+                           ('other.gif', gif(5, 7))]:
+            with open(os.path.join(self.srcdir, 'img', name), 'wb') as fout:
+                fout.write(data)
+        documents = {
+            'index.rst': u'Index\n=====\n\n.. toctree::\n\n   a\n   b\n   c\n',
+            'a.md': u'# A\n\n![shot](img/shot.gif) ![copy](img/copy.gif)\n\n'
+                    u'![other](img/other.gif) ![shot](img/shot.gif)\n',
+            'b.md': u'# B\n\n![copy](img/copy.gif) ![remote](http://x/y.gif)\n',
+            'c.rst': u'C\n=\n\n.. image:: img/copy.gif\n',
+        }
+        for name, text in documents.items():
+            with io.open(os.path.join(self.srcdir, name), 'w') as fout:
+                fout.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self):
+        app = Sphinx(
+            srcdir=self.srcdir,
+            confdir=self.srcdir,
+            outdir=os.path.join(self.tmpdir, 'html'),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername='html',
+            status=None,
+            warning=io.StringIO(),
+        )
+        app.build()
+        return app
+
+    def read(self, name):
+        with io.open(os.path.join(self.tmpdir, 'html', name),
+                     encoding='utf-8') as fin:
+            return fin.read()
+
+    def test_manifest(self):
+        from recommonmark import images
+
+        hashed = []
+        original = images._hash_file
+
+        def hash_file(path):
+            hashed.append(os.path.basename(path))
+            return original(path)
+
+        images._hash_file = hash_file
+        try:
+            self.build()
+            self.assertEqual(sorted(hashed), ['copy.gif', 'other.gif',
+                                              'shot.gif'])
+            manifest = json.loads(self.read('recommonmark_images.json'))
+            self.assertEqual(manifest['documents'], {
+                'a': ['img/shot.gif', 'img/copy.gif', 'img/other.gif'],
+                'b': ['img/copy.gif'],
+            })
+            shot = manifest['images']['img/shot.gif']
+            self.assertEqual((shot['width'], shot['height'], shot['size']),
+                             (3, 2, len(gif(3, 2))))
+            self.assertEqual(manifest['images']['img/copy.gif']['sha1'],
+                             shot['sha1'])
+            self.assertEqual(
+                manifest['images']['img/copy.gif']['output'], 'copy.gif')
+            # Identical images are copied once, under the smallest path
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(self.tmpdir, 'html',
+                                               '_images'))),
+                ['copy.gif', 'other.gif'])
+            for name in ['a.html', 'b.html', 'c.html']:
+                self.assertNotIn('shot.gif', self.read(name))
+            self.assertIn('src="_images/copy.gif"', self.read('a.html'))
+
+            # Unchanged images are not hashed again
+            del hashed[:]
+            os.utime(os.path.join(self.srcdir, 'a.md'), None)
+            self.build()
+            self.assertEqual(hashed, [])
+            with open(os.path.join(self.srcdir, 'img', 'shot.gif'),
+                      'wb') as fout:
+                fout.write(gif(4, 4))
+            self.build()
+            self.assertEqual(hashed, ['shot.gif'])
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(self.tmpdir, 'html',
+                                               '_images'))),
+                ['copy.gif', 'other.gif', 'shot.gif'])
+            self.assertIn('src="_images/shot.gif"', self.read('a.html'))
+        finally:
+            images._hash_file = original
+
+    def test_targets_change(self):
+        with io.open(os.path.join(self.srcdir, 'index.rst'), 'a') as fout:
+            fout.write(u'   d\n')
+        with io.open(os.path.join(self.srcdir, 'd.md'), 'w') as fout:
+            fout.write(u'# D\n\n![shot](img/shot.gif)\n')
+        self.build()
+        self.assertIn('src="_images/copy.gif"', self.read('d.html'))
+        # d is not read again, but its image is no longer a copy of the
+        # image it was pointed to
+        with open(os.path.join(self.srcdir, 'img', 'copy.gif'), 'wb') as fout:
+            fout.write(gif(4, 4))
+        app = self.build()
+        self.assertEqual(app.env.recommonmark_image_targets, {})
+        self.assertIn('src="_images/shot.gif"', self.read('d.html'))
+        self.assertIn('src="_images/copy.gif"', self.read('b.html'))
+
+
+class WarmUpTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_app(self, parallel):
+        warnings = io.StringIO()
+        app = Sphinx(
+            srcdir='tests/sphinx_toctree',
+            confdir='tests/sphinx_toctree',
+            outdir=os.path.join(self.tmpdir, 'html'),
+            doctreedir=os.path.join(self.tmpdir, 'doctrees'),
+            buildername='html',
+            status=None,
+            warning=warnings,
+            parallel=parallel,
+        )
+        return app, warnings
+
+    def test_warm_up(self):
+        app, _ = self.make_app(1)
+        self.assertFalse(hasattr(app, 'recommonmark_caches'))
+
+        app, warnings = self.make_app(2)
+        self.assertIn(('math', 'en'),
+                      app.recommonmark_caches['role_functions'])
+        self.assertNotIn('warm-up', warnings.getvalue())
+        app.build()
+        self.assertNotIn('warm-up', warnings.getvalue())